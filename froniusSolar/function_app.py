@@ -1,33 +1,115 @@
 # 11/09/2025 10:30 Writing to main
 import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import azure.functions as func
 from azure.keyvault.secrets import SecretClient
-from azure.identity import DefaultAzureCredential
+from azure.identity import DefaultAzureCredential, ManagedIdentityCredential
 
 from helpers.helpers import generate_tsdb_inserts, get_aggrdata, write_to_timescale # type: ignore
 from helpers.token_refresh import get_active_token  # type: ignore
 
 app = func.FunctionApp()
 
-@app.timer_trigger(schedule="0 0/30 * * * *", arg_name="myTimer", run_on_startup=False,
-              use_monitor=False) 
-def froniusIngest(myTimer: func.TimerRequest) -> None:
+KV_URI = "https://wffunctionappsvault.vault.azure.net/"
+
+PV_ID = '5e008b2b-d907-4a39-8cf7-3e7d949c9e3e'
+
+FRONIUS_URLS = {
+        # Define the API endpoint and JWT token endpoint
+        "BASE_URL": 'https://api.solarweb.com/swqapi/',
+        "AGGRDATA_URL": "pvsystems/" + PV_ID + "/aggrdata?period=total",
+        "JWT_ENDPOINT": 'iam/jwt'
+    }
+FRONIUS_URLS["JWT_URL"] = FRONIUS_URLS["BASE_URL"] + FRONIUS_URLS["JWT_ENDPOINT"]
+
+AGG_URL = FRONIUS_URLS["BASE_URL"] + FRONIUS_URLS["AGGRDATA_URL"]
+
+# Hardcoded channel values requested by client.
+# Manually assigned sensor IDs for tsdb format
+METRICS_MAP = {"EnergyProductionTotal" :'8',
+           "EnergySelfConsumption":'2',
+           "EnergyPurchased":'5',
+           "EnergyFeedIn":'6',
+           "EnergyBattCharge":'7',
+           "EnergyBattDischarge":'4',
+           "EnergyConsumptionTotal":'3',
+           "EnergyBattChargeGrid":'1'}
+
+# In-memory token cache, kept at module scope so warm invocations reuse the JWT
+token_info = {
+    "jwt_token": "",
+    "refresh_token": "",
+    "jwt_expires": 0,}
+
+# Key Vault client is created once per worker. No network at import time,
+# the credential only fetches a token on the first get_secret call.
+# In Azure only the managed identity applies, so skip the DefaultAzureCredential probe chain;
+# local runs (WEBSITE_INSTANCE_ID unset) still fall back to CLI/VS Code logins
+@lru_cache(maxsize=None)
+def _get_kv_client() -> SecretClient:
+    if os.getenv("WEBSITE_INSTANCE_ID"):
+        credential = ManagedIdentityCredential()
+    else:
+        credential = DefaultAzureCredential()
+    return SecretClient(vault_url=KV_URI, credential=credential)
+
+# Secrets are cached per worker so warm invocations skip Key Vault, and re-read after SECRET_TTL_SECS
+# so a rotated password is still picked up without a restart
+SECRET_TTL_SECS = 6 * 60 * 60
+_secret_cache = {}
+
+# Cached value if it is still within SECRET_TTL_SECS, otherwise None
+def _cached_secret(name: str):
+    cached = _secret_cache.get(name)
+    if cached and time.monotonic() - cached[1] < SECRET_TTL_SECS:
+        return cached[0]
+    return None
+
+def _get_secret(name: str) -> str:
+    value = _cached_secret(name)
+    if value is not None:
+        return value
+    value = _get_kv_client().get_secret(name).value
+    _secret_cache[name] = (value, time.monotonic())
+    return value
+
+# Returns cached secrets directly and fetches only the missing ones concurrently,
+# each Key Vault call is an independent round-trip. Warm runs never start a pool
+def _get_secrets(*names: str) -> dict:
+    secrets = {}
+    missing = []
+    for name in names:
+        value = _cached_secret(name)
+        if value is None:
+            missing.append(name)
+        else:
+            secrets[name] = value
+    if missing:
+        # Build the Key Vault client here first: lru_cache doesn't serialise a cold first call,
+        # so pool threads racing on it would each create their own credential and token
+        _get_kv_client()
+        with ThreadPoolExecutor(max_workers=len(missing)) as ex:
+            secrets.update(zip(missing, ex.map(_get_secret, missing)))
+    return secrets
+
+# Access keys come from the cached secrets, so the headers only need building once per worker
+@lru_cache(maxsize=8)
+def _build_headers(access_key_id: str, access_key_value: str) -> dict:
+    return {
+        "accept": "application/json",
+        "AccessKeyId": access_key_id,
+        "AccessKeyValue": access_key_value
+        }
+
+# Shared ingest body for the timer trigger and local test runs
+def _run_fronius_ingest() -> None:
     try:
         logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
         logging.info("Fronius Ingest started")
-        KV_URI = "https://wffunctionappsvault.vault.azure.net/"
-        credential = DefaultAzureCredential()
-        kv = SecretClient(vault_url=KV_URI, credential=credential)
-
-        # DB config
-        db_conf = {
-            "password": kv.get_secret("tsdbPassword").value,
-            "port":     kv.get_secret("tsdbPort").value,
-            "host":     kv.get_secret("tsdbHost").value,
-            "name":     kv.get_secret("tsdbName").value,
-            "user":     kv.get_secret("tsdbUser").value,
-        }
 
         #TODO Add function to get client and location ID from TSDB    
         #_get_client_pv_details()
@@ -36,138 +118,34 @@ def froniusIngest(myTimer: func.TimerRequest) -> None:
         gateway = "A"
         metric = "solar"
 
-        client_conf = {
-            "pv_id": kv.get_secret(f"{client_id}-pvId").value,
-            "access_key_id": kv.get_secret(f"{client_id}-accessKeyId").value,
-            "access_key_value": kv.get_secret(f"{client_id}-accessKeyValue").value,
-            "user_id": kv.get_secret(f"{client_id}-userId").value,
-            "user_password": kv.get_secret(f"{client_id}-userPassword").value,
-        }
-
-        PV_ID = '5e008b2b-d907-4a39-8cf7-3e7d949c9e3e'
-
-        fronius_urls = {
-                # Define the API endpoint and JWT token endpoint
-                "BASE_URL": 'https://api.solarweb.com/swqapi/',
-                "AGGRDATA_URL": "pvsystems/" + PV_ID + "/aggrdata?period=total",
-                "JWT_ENDPOINT": 'iam/jwt'
-            }
-        
-        agg_url = fronius_urls["BASE_URL"] + fronius_urls["AGGRDATA_URL"]
-
-        # Hardcoded channel values requested by client.
-        # Manually assigned sensor IDs for tsdb format
-        METRICS_MAP = {"EnergyProductionTotal" :'8',
-                   "EnergySelfConsumption":'2',
-                   "EnergyPurchased":'5',
-                   "EnergyFeedIn":'6',
-                   "EnergyBattCharge":'7',
-                   "EnergyBattDischarge":'4',
-                   "EnergyConsumptionTotal":'3',
-                   "EnergyBattChargeGrid":'1'}
-        
-        # In-memory cache
-        token_info = {
-            "jwt_token": "",
-            "refresh_token": "",
-            "jwt_expires": 0,}
-        
-        headers = {
-            "accept": "application/json",
-            "AccessKeyId": client_conf["access_key_id"],
-            "AccessKeyValue": client_conf["access_key_value"]
-            }
-
-        token = get_active_token(token_info, fronius_urls, client_conf)
-        data  = get_aggrdata(token, headers, agg_url)
-        print(data)
-
-        rows = generate_tsdb_inserts(
-            data,
-            client_id=client_id,
-            location_id=location_id,
-            gateway=gateway,
-            metric=metric,
-            metrics_map=METRICS_MAP,
+        secrets = _get_secrets(
+            "tsdbPassword", "tsdbPort", "tsdbHost", "tsdbName", "tsdbUser",
+            f"{client_id}-pvId", f"{client_id}-accessKeyId", f"{client_id}-accessKeyValue",
+            f"{client_id}-userId", f"{client_id}-userPassword",
         )
-        print(rows)
-
-        write_to_timescale(db_conf, rows)
-
-    except Exception as e:
-        logging.exception("Startup failure in SmartFlow timer handler: %s", e)
-
-    logging.info('Fronius Ingest timer trigger function executed.')
-
-def test():
-    try:
-        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-        logging.info("Fronius Ingest started")
-        KV_URI = "https://wffunctionappsvault.vault.azure.net/"
-        credential = DefaultAzureCredential()
-        kv = SecretClient(vault_url=KV_URI, credential=credential)
 
         # DB config
         db_conf = {
-            "password": kv.get_secret("tsdbPassword").value,
-            "port":     kv.get_secret("tsdbPort").value,
-            "host":     kv.get_secret("tsdbHost").value,
-            "name":     kv.get_secret("tsdbName").value,
-            "user":     kv.get_secret("tsdbUser").value,
+            "password": secrets["tsdbPassword"],
+            "port":     secrets["tsdbPort"],
+            "host":     secrets["tsdbHost"],
+            "name":     secrets["tsdbName"],
+            "user":     secrets["tsdbUser"],
         }
 
-        #TODO Add function to get client and location ID from TSDB    
-        #_get_client_pv_details()
-        client_id = "CTa9Xz7FbL2"
-        location_id = "Lpx4WvbHkq"
-        gateway = "A"
-        metric = "solar"
-
         client_conf = {
-            "pv_id": kv.get_secret(f"{client_id}-pvId").value,
-            "access_key_id": kv.get_secret(f"{client_id}-accessKeyId").value,
-            "access_key_value": kv.get_secret(f"{client_id}-accessKeyValue").value,
-            "user_id": kv.get_secret(f"{client_id}-userId").value,
-            "user_password": kv.get_secret(f"{client_id}-userPassword").value,
+            "pv_id": secrets[f"{client_id}-pvId"],
+            "access_key_id": secrets[f"{client_id}-accessKeyId"],
+            "access_key_value": secrets[f"{client_id}-accessKeyValue"],
+            "user_id": secrets[f"{client_id}-userId"],
+            "user_password": secrets[f"{client_id}-userPassword"],
         }
 
-        PV_ID = '5e008b2b-d907-4a39-8cf7-3e7d949c9e3e'
-
-        fronius_urls = {
-                # Define the API endpoint and JWT token endpoint
-                "BASE_URL": 'https://api.solarweb.com/swqapi/',
-                "AGGRDATA_URL": "pvsystems/" + PV_ID + "/aggrdata?period=total",
-                "JWT_ENDPOINT": 'iam/jwt'
-            }
-        
-        agg_url = fronius_urls["BASE_URL"] + fronius_urls["AGGRDATA_URL"]
-
-        # Hardcoded channel values requested by client.
-        # Manually assigned sensor IDs for tsdb format
-        METRICS_MAP = {"EnergyProductionTotal" :'8',
-                   "EnergySelfConsumption":'2',
-                   "EnergyPurchased":'5',
-                   "EnergyFeedIn":'6',
-                   "EnergyBattCharge":'7',
-                   "EnergyBattDischarge":'4',
-                   "EnergyConsumptionTotal":'3',
-                   "EnergyBattChargeGrid":'1'}
-        
-        # In-memory cache
-        token_info = {
-            "jwt_token": "",
-            "refresh_token": "",
-            "jwt_expires": 0,}
-        
-        headers = {
-            "accept": "application/json",
-            "AccessKeyId": client_conf["access_key_id"],
-            "AccessKeyValue": client_conf["access_key_value"]
-            }
-
-        token = get_active_token(token_info, fronius_urls, client_conf)
-        data  = get_aggrdata(token, headers, agg_url)
-        print(data)
+        headers = _build_headers(client_conf["access_key_id"], client_conf["access_key_value"])
+
+        token = get_active_token(token_info, FRONIUS_URLS, client_conf)
+        data  = get_aggrdata(token, headers, AGG_URL)
+        logging.debug("aggrdata keys: %s", list(data.keys()) if data else None)
 
         rows = generate_tsdb_inserts(
             data,
@@ -177,12 +155,20 @@ def test():
             metric=metric,
             metrics_map=METRICS_MAP,
         )
-        print(rows)
 
         write_to_timescale(db_conf, rows)
 
     except Exception as e:
         logging.exception("Startup failure in SmartFlow timer handler: %s", e)
 
+@app.timer_trigger(schedule="0 0/30 * * * *", arg_name="myTimer", run_on_startup=False,
+              use_monitor=False) 
+def froniusIngest(myTimer: func.TimerRequest) -> None:
+    _run_fronius_ingest()
+    logging.info('Fronius Ingest timer trigger function executed.')
+
+def test():
+    _run_fronius_ingest()
+
 if __name__ == "__main__":
     test()
\ No newline at end of file
@@ -1,27 +1,37 @@
-import requests, logging, pg8000
-from datetime import datetime, timezone, time
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+import requests, logging, pg8000, orjson
+from datetime import datetime, timezone
+from urllib3.util.retry import Retry
+# The Functions host already configures the root logger, only set one up for local runs
+if not logging.getLogger().hasHandlers():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Shared across the token and data calls so the Solar.web connection is kept alive.
+# GETs are retried with exponential backoff by urllib3 on connection errors and 429/5xx
+retry = Retry(
+    total=3,
+    backoff_factor=5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["GET"],
+    raise_on_status=False,
+)
+session = requests.Session()
+session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=10, max_retries=retry))
 
 #Get aggrdata via API request with the JWT token
-def get_aggrdata(jwt_token: str, headers, url: str, max_retries: int = 3, backoff_secs: int = 5):
-    for attempt in range(1, max_retries + 1):
-        try:
-            resp = requests.get(url, headers=headers, timeout=15)
-            resp.raise_for_status()
-            logging.info("✅ Data fetched successfully.")
-            return resp.json()
-        except requests.HTTPError as e:
-            status = e.response.status_code if e.response is not None else "n/a"
-            body   = e.response.text[:500] if e.response is not None else ""
-            logging.error("HTTPError on GET %s (status %s): %s", url, status, body)
-        except requests.RequestException as e:
-            logging.error("RequestException on GET %s: %s", url, e)
-        if attempt < max_retries:
-            wait = backoff_secs * (2 ** (attempt - 1))
-            logging.info("Retrying in %s seconds (attempt %d/%d)...", wait, attempt + 1, max_retries)
-            time.sleep(wait)
-    logging.error("Exhausted retries for %s", url)
+def get_aggrdata(jwt_token: str, headers, url: str):
+    try:
+        resp = session.get(url, headers=headers, timeout=15)
+        resp.raise_for_status()
+        logging.info("✅ Data fetched successfully.")
+        return orjson.loads(resp.content)
+    except requests.HTTPError as e:
+        status = e.response.status_code if e.response is not None else "n/a"
+        body   = e.response.text[:500] if e.response is not None else ""
+        logging.error("HTTPError on GET %s (status %s): %s", url, status, body)
+    except requests.RequestException as e:
+        logging.error("RequestException on GET %s: %s", url, e)
+    except orjson.JSONDecodeError as e:
+        logging.error("Invalid JSON from GET %s: %s", url, e)
     return None
 
 # Generates tsdb insert values based on data received from Fronius API
@@ -33,27 +43,23 @@ def generate_tsdb_inserts(data, *, client_id, location_id, gateway: str, metric:
     try:
         entry = data["data"][0]
         ts = datetime.now(timezone.utc)  
+        gateway = str(gateway)
         channels = entry.get("channels", []) or []
-        for ch in channels:
-            metric_name = ch.get("channelName")
-            if not metric_name:
-                continue
-            sensor_id = metrics_map.get(metric_name)
-            if sensor_id is None:
-                continue
-            
-            value = ch.get("value", 0) or 0
-            note = metric_name
-            rows.append((
-                ts,                         # time (datetime with tz)
-                client_id,                  # client_id
-                location_id,                # location_id
-                metric,                     # metric 
-                float(value),               # value
-                str(gateway),               # gateway
-                int(sensor_id),             # sensor 
-                note                        # note
-            ))
+        # Channels without a mapped sensor ID are skipped. note is the channel name
+        rows = [
+            (
+                ts,                                 # time (datetime with tz)
+                client_id,                          # client_id
+                location_id,                        # location_id
+                metric,                             # metric 
+                float(ch.get("value", 0) or 0),     # value
+                gateway,                            # gateway
+                int(sensor_id),                     # sensor 
+                ch["channelName"],                  # note
+            )
+            for ch in channels
+            if (sensor_id := metrics_map.get(ch.get("channelName"))) is not None
+        ]
         logging.info("Prepared %d rows for insert", len(rows))
     except Exception as e:
         logging.exception("[generate_tsdb_inserts] Failed to build rows: %s", e)
@@ -67,6 +73,8 @@ def _query_db(db_conf: dict, query, params=None, fetch=True, many=False):
             user=db_conf["user"],
             password=db_conf["password"],
             port=int(db_conf["port"]),
+            application_name="fronius_ingest",
+            tcp_keepalive=True,
         ) as connection:
             with connection.cursor() as cursor:
                 if many:
@@ -81,20 +89,22 @@ def _query_db(db_conf: dict, query, params=None, fetch=True, many=False):
         return [] if fetch else False
     
 # Writes to tsdb using SQL insert format and records from generate_tsdb_inserts
+# All rows go in a single multi-row INSERT, one round-trip instead of one per row
 def write_to_timescale(db_conf, rows):
     if not rows:
         logging.info("No rows to insert.")
         return
-    insert_sql = """
+    values = ",\n          ".join(["(%s, %s, %s, %s, %s, %s, %s, %s)"] * len(rows))
+    insert_sql = f"""
         INSERT INTO main
           (time, client_id, location_id, metric, value, gateway, sensor, note)
         VALUES
-          (%s, %s, %s, %s, %s, %s, %s, %s)
+          {values}
         ON CONFLICT (time, client_id, location_id, metric, gateway, sensor)
         DO NOTHING;
     """
-    # IMPORTANT: pass rows as params and set many=True
-    ok = _query_db(db_conf, insert_sql, params=rows, fetch=False, many=True)
+    params = [value for row in rows for value in row]
+    ok = _query_db(db_conf, insert_sql, params=params, fetch=False)
     if ok is False:
         logging.error("Insert failed; see previous exception.")
     else:
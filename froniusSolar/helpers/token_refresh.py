@@ -1,29 +1,23 @@
 import logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s — %(levelname)s — %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
+# The Functions host already configures the root logger, only set one up for local runs
+if not logging.getLogger().hasHandlers():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s — %(levelname)s — %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
 import requests
 import time
 from typing import Tuple
-from datetime import datetime
+from datetime import datetime, timezone
 
-TOKEN_PY_PATH = "/tmp/fronius_token_info.py"
+from helpers.helpers import session  # type: ignore
 
-
-def write_token_to_file(token_info) -> None:
-    content = f"""# Auto-generated Fronius token info
-                jwt_token = "{token_info['jwt_token']}"
-                refresh_token = "{token_info['refresh_token']}"
-                jwt_expires = {token_info['jwt_expires']}
-                """
-    with open(TOKEN_PY_PATH, "w") as f:
-        f.write(content)
-    logging.info(f"✅ Token info written to {TOKEN_PY_PATH}")
+EXPIRY_SKEW_SECS = 60
 
 def fetch_token(token_info, fronius_urls, client_conf, grant_type: str, payload: dict) -> dict:
-    JWT_URL        = fronius_urls["BASE_URL"] + fronius_urls["JWT_ENDPOINT"]
+    # function_app precomputes JWT_URL at module load; fall back for callers that don't
+    JWT_URL        = fronius_urls.get("JWT_URL") or fronius_urls["BASE_URL"] + fronius_urls["JWT_ENDPOINT"]
     REFRESH_URL    = JWT_URL + "/" + token_info["refresh_token"]
     headers = {
     "accept": "application/json",
@@ -32,7 +26,7 @@ def fetch_token(token_info, fronius_urls, client_conf, grant_type: str, payload:
     }
     
     url = JWT_URL if grant_type == "password" else REFRESH_URL
-    method = requests.post if grant_type == "password" else requests.patch
+    method = session.post if grant_type == "password" else session.patch
 
     response = method(url, json=payload if grant_type == "password" else None, headers=headers, timeout=10)
 
@@ -60,26 +54,27 @@ def get_token(token_info, fronius_urls, client_conf, use_refresh: bool = False)
     token_info["refresh_token"] = data["refreshToken"]
     token_info["jwt_expires"] = timestamp_to_epoch(data["jwtTokenExpiration"])
 
-    write_token_to_file(token_info)
     logging.info("✅ Tokens and expiries updated.")
 
+# Expiry timestamps are UTC ('...Z'). Sub-second precision is dropped by int() anyway,
+# so only the seconds part is parsed. Also handles timestamps with no fractional part
 def timestamp_to_epoch(timestamp: str) -> int:
-    base, frac = timestamp[:-1].split('.')
-    frac = (frac + "000000")[:6]
-    iso = f"{base}.{frac}+00:00"
-
-    dt = datetime.fromisoformat(iso)
-    epoch = int(dt.timestamp())
-
-    return epoch
+    dt = datetime.fromisoformat(timestamp[:19]).replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
 
+# token_info lives at module scope in function_app.py so the JWT survives across warm invocations.
+# Tokens are treated as expired EXPIRY_SKEW_SECS early to avoid using one the server has already expired
 def get_active_token(token_info, fronius_urls, client_conf) -> Tuple[str, str]:
     now = int(time.time())
 
     if not token_info["jwt_token"]:
         get_token(token_info, fronius_urls, client_conf, use_refresh=False)
-    elif now >= token_info["jwt_expires"]:
-        get_token(token_info, fronius_urls, client_conf, use_refresh=True)
+    elif now >= token_info["jwt_expires"] - EXPIRY_SKEW_SECS:
+        try:
+            get_token(token_info, fronius_urls, client_conf, use_refresh=True)
+        except requests.HTTPError:
+            logging.warning("Refresh failed, falling back to a new jwt token")
+            get_token(token_info, fronius_urls, client_conf, use_refresh=False)
     else:
         logging.info("✅ Access token still valid.")
 
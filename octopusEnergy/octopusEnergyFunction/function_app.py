@@ -1,6 +1,9 @@
 # 22-08-2025 09:30.
-import logging, requests, pg8000
+import logging, requests, pg8000, orjson, time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime as dt, timedelta, timezone
+from io import StringIO
 
 import azure.functions as func
 
@@ -9,67 +12,187 @@ from azure.identity import DefaultAzureCredential, ManagedIdentityCredential
 
 app = func.FunctionApp()
 
+# Reused across pages and clients so the Octopus API connection is kept alive
+session = requests.Session()
+session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=10))
+
 # Helpers > no network at import time. Avoids indexing issues
 
-# Initialise Key Vault Client
+# Initialise Key Vault Client once per worker, reused across warm invocations
+@lru_cache(maxsize=None)
 def _get_kv_client():
     logging.info("Initialising Key Vault Client with ManagedIdentityCredential")
     kv_uri = "https://wffunctionappsvault.vault.azure.net/"
     credential = ManagedIdentityCredential()
     return SecretClient(vault_url=kv_uri, credential=credential)
 
-# Gets secrets using KV Client
-def _get_secret(client: SecretClient, name: str) -> str:
-    return client.get_secret(name).value
+# Secrets are cached per worker so warm invocations skip Key Vault, and re-read after SECRET_TTL_SECS
+# so a rotated password is still picked up without a restart
+SECRET_TTL_SECS = 6 * 60 * 60
+_secret_cache = {}
+
+# Cached value if it is still within SECRET_TTL_SECS, otherwise None
+def _cached_secret(name: str):
+    cached = _secret_cache.get(name)
+    if cached and time.monotonic() - cached[1] < SECRET_TTL_SECS:
+        return cached[0]
+    return None
+
+def _get_secret(name: str) -> str:
+    value = _cached_secret(name)
+    if value is not None:
+        return value
+    value = _get_kv_client().get_secret(name).value
+    _secret_cache[name] = (value, time.monotonic())
+    return value
+
+# Returns cached secrets directly and fetches only the missing ones concurrently.
+# With strict=False a missing secret is logged and left out of the result,
+# so one misconfigured client doesn't fail the rest
+def _get_secrets(names, strict: bool = True) -> dict:
+    secrets = {}
+    missing = []
+    for name in dict.fromkeys(names):
+        value = _cached_secret(name)
+        if value is None:
+            missing.append(name)
+        else:
+            secrets[name] = value
+    if not missing:
+        return secrets
+    # Build the Key Vault client here first: lru_cache doesn't serialise a cold first call,
+    # so pool threads racing on it would each create their own credential and token
+    _get_kv_client()
+    with ThreadPoolExecutor(max_workers=len(missing)) as ex:
+        futures = {name: ex.submit(_get_secret, name) for name in missing}
+    for name, fut in futures.items():
+        err = fut.exception()
+        if err is None:
+            secrets[name] = fut.result()
+        elif strict:
+            raise err
+        else:
+            logging.error("Could not fetch secret %s: %s", name, err)
+    return secrets
+
+# Open a database connection. The timer handler opens one per run and passes it
+# to every query as conn, saving a TCP/TLS/auth handshake per query
+def _connect_db(db_conf: dict):
+    return pg8000.connect(
+        host=db_conf["host"],
+        database=db_conf["name"],
+        user=db_conf["user"],
+        password=db_conf["password"],
+        port=int(db_conf["port"]),
+        application_name="octopus_ingest",
+        tcp_keepalive=True,
+    )
+
+# Roll back a failed transaction so a shared connection stays usable
+def _rollback(connection) -> None:
+    try:
+        connection.rollback()
+    except Exception:
+        pass
 
-# Query database
-def _query_db(db_conf: dict, query, params=None, fetch=True, many=False):
+# Query database. Uses conn when given, otherwise a one-off connection
+def _query_db(db_conf: dict, query, params=None, fetch=True, many=False, conn=None):
+    connection = None
     try:
-        with pg8000.connect(
-            host=db_conf["host"],
-            database=db_conf["name"],
-            user=db_conf["user"],
-            password=db_conf["password"],
-            port=int(db_conf["port"]),
-        ) as connection:
-            with connection.cursor() as cursor:
-                if many:
-                    cursor.executemany(query, params)
-                else:
-                    cursor.execute(query, params or [])
-                if fetch:
-                    return cursor.fetchall()
-            connection.commit()
+        connection = conn or _connect_db(db_conf)
+        with connection.cursor() as cursor:
+            if many:
+                cursor.executemany(query, params)
+            else:
+                cursor.execute(query, params or [])
+            records = cursor.fetchall() if fetch else None
+        # Reads are committed too, so a shared conn isn't left idle in a transaction while the caller works
+        connection.commit()
+        return records
     except Exception as e:
         logging.exception(f"Database operation failed: {e}")
+        if connection is not None:
+            _rollback(connection)
         return [] if fetch else False
+    finally:
+        if conn is None and connection is not None:
+            connection.close()
+
+# COPY text format: None is \N, and backslash, tab, newline and carriage return are backslash-escaped
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+def _copy_field(v) -> str:
+    return "\\N" if v is None else str(v).translate(_COPY_ESCAPES)
 
-# Get consumption data from Octopus Energy
+# Bulk load rows with COPY into a temp table, then INSERT ... ON CONFLICT into main.
+# One streamed COPY instead of an INSERT round-trip per row
+def _copy_rows_to_tsdb(db_conf: dict, rows, conn=None) -> bool:
+    buf = StringIO()
+    for r in rows:
+        buf.write("\t".join(map(_copy_field, r)) + "\n")
+    buf.seek(0)
+    connection = None
+    try:
+        connection = conn or _connect_db(db_conf)
+        cursor = connection.cursor()
+        cursor.execute("""
+            CREATE TEMP TABLE _ingest_octopus
+            (LIKE main INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+            ON COMMIT DROP;
+        """)
+        cursor.execute(
+            "COPY _ingest_octopus (time, client_id, location_id, metric, value, gateway, sensor, note) "
+            "FROM stdin WITH (FORMAT text)",
+            stream=buf,
+        )
+        cursor.execute("""
+            INSERT INTO main (time, client_id, location_id, metric, value, gateway, sensor, note)
+            SELECT time, client_id, location_id, metric, value, gateway, sensor, note
+            FROM _ingest_octopus
+            ON CONFLICT (time, client_id, location_id, metric, gateway, sensor) DO NOTHING;
+        """)
+        connection.commit()
+        return True
+    except Exception as e:
+        logging.exception(f"Database COPY/INSERT failed: {e}")
+        if connection is not None:
+            _rollback(connection)
+        return False
+    finally:
+        if conn is None and connection is not None:
+            connection.close()
+
+# Get consumption data from Octopus Energy. Yields results page by page
 def _get_consumption_data(api_key: str, url: str):
     logging.info("Getting consumption data...")
-    all_results, next_url = [], url
+    next_url = url
     while next_url:
-        resp = requests.get(next_url, auth=(api_key, ""), timeout=10)
+        resp = session.get(next_url, auth=(api_key, ""), timeout=10)
         logging.info("Request URL: %s, status: %s", next_url, resp.status_code)
         resp.raise_for_status()
-        data = resp.json()
-        all_results.extend(data.get("results", []))
+        data = orjson.loads(resp.content)
+        yield from data.get("results", [])
         next_url = data.get("next")
-    return all_results
 
-# Parse consumption results
+# Convert an ISO8601 interval timestamp to naive UTC 'YYYY-MM-DDTHH:MM:SS'.
+# Octopus mostly returns UTC ('Z'), which only needs slicing; offsets (BST) go through datetime
+def _to_naive_utc(ts: str) -> str:
+    if len(ts) == 20 and ts[19] == "Z" or len(ts) == 25 and ts.endswith("+00:00"):
+        return ts[:19]
+    return (
+        dt.fromisoformat(ts.replace("Z", "+00:00"))
+        .astimezone(timezone.utc)
+        .strftime("%Y-%m-%dT%H:%M:%S")
+    )
+
+# Parse consumption results into (utc timestamp, value) tuples
 def _parse_consumption_results(consumption_json):
     logging.info("Parsing consumption results...")
-    out = []
-    for r in consumption_json:
-        # Scaling up for metric visibility on web app. Potential for change
-        consumption = r["consumption"] * 1000
-        ts = r["interval_end"]
-        if ts.endswith("Z"):
-            ts = ts.replace("Z", "+00:00")
-        dts_utc = dt.fromisoformat(ts).astimezone(timezone.utc)
-        out.append([dts_utc.strftime("%Y-%m-%dT%H:%M:%S"), consumption])
-    return out
+    # Scaling up for metric visibility on web app. Potential for change
+    return (
+        (_to_naive_utc(r["interval_end"]), r["consumption"] * 1000)
+        for r in consumption_json
+    )
 
 # Create rows for writing to database
 def _create_rows(parsed, client_id, location_id, mpan):
@@ -77,11 +200,33 @@ def _create_rows(parsed, client_id, location_id, mpan):
     gateway = "A"
     sensor_id = "1"
     metric = "electricity"
-    rows = [
-        [ts, client_id, location_id, metric, val, gateway, sensor_id, mpan]
+    return (
+        (ts, client_id, location_id, metric, val, gateway, sensor_id, mpan)
         for ts, val in parsed
-    ]
-    return rows
+    )
+
+# Fetch and build rows for one client. Runs on a worker thread, so failures are
+# logged and return no rows rather than stopping the other clients
+def _get_client_rows(client_id, mpan, serial, location_id, api_key, period_from, period_to) -> list:
+    logging.info(f"Processing client {client_id}")
+    try:
+        url = (
+            f"https://api.octopus.energy/v1/electricity-meter-points/"
+            f"{mpan}/meters/{serial}/consumption?"
+            f"page_size=100&period_from={period_from}&period_to={period_to}&order_by=period"
+        )
+        # Pages stream through parse and row creation, no intermediate lists
+        data = _get_consumption_data(api_key, url)
+        parsed = _parse_consumption_results(data)
+        rows = list(_create_rows(parsed, client_id, location_id, mpan))
+        if not rows:
+            logging.warning("No data for client %s", client_id)
+        else:
+            logging.info("Prepared %d rows for client %s", len(rows), client_id)
+        return rows
+    except Exception as e:
+        logging.exception("Client %s failed: %s", client_id, e)
+        return []
 
 #  Timer entrypoint, safe to index after this point
 
@@ -96,26 +241,33 @@ def octopusEnergy(octoTimer: func.TimerRequest) -> None:
     if octoTimer.past_due:
         logging.info("The timer is past due!")
 
+    conn = None
     try:
         # All external setup happens here
-        kv = _get_kv_client()
-
+        secrets = _get_secrets(["tsdbPassword", "tsdbPort", "tsdbHost", "tsdbName", "tsdbUser"])
         db_conf = {
-            "password": _get_secret(kv, "tsdbPassword"),
-            "port": _get_secret(kv, "tsdbPort"),
-            "host": _get_secret(kv, "tsdbHost"),
-            "name": _get_secret(kv, "tsdbName"),
-            "user": _get_secret(kv, "tsdbUser"),
+            "password": secrets["tsdbPassword"],
+            "port": secrets["tsdbPort"],
+            "host": secrets["tsdbHost"],
+            "name": secrets["tsdbName"],
+            "user": secrets["tsdbUser"],
         }
 
-        # Get active Octopus Energy clients
+        # One connection for every query in this run
+        conn = _connect_db(db_conf)
+
+        # Get active Octopus Energy clients with their location in one query
         clients = _query_db(
             db_conf,
             """
-            SELECT client_id, mpan, serial, api_key_secret_name
-            FROM octopus_energy_config
-            WHERE is_active = true;
+            SELECT c.client_id, c.mpan, c.serial, c.api_key_secret_name,
+                (SELECT l.location_id FROM locations l
+                 WHERE l.client_id = c.client_id
+                 ORDER BY l.location_id LIMIT 1) AS location_id
+            FROM octopus_energy_config c
+            WHERE c.is_active = true;
             """,
+            conn=conn,
         )
         if not clients:
             logging.warning("No active clients found.")
@@ -125,52 +277,40 @@ def octopusEnergy(octoTimer: func.TimerRequest) -> None:
         period_from = (dt.now(timezone.utc) - timedelta(days=3)).strftime("%Y-%m-%dT%H:%MZ")
         period_to = dt.now(timezone.utc).strftime("%Y-%m-%dT%H:%MZ")
 
-        #Create consumption URL for each active client
-        for client_id, mpan, serial, secret_name in clients:
-            logging.info(f"Processing client {client_id}")
-            try:
-                api_key = _get_secret(kv, secret_name)
-                url = (
-                    f"https://api.octopus.energy/v1/electricity-meter-points/"
-                    f"{mpan}/meters/{serial}/consumption?"
-                    f"page_size=100&period_from={period_from}&period_to={period_to}&order_by=period"
-                )
-                data = _get_consumption_data(api_key, url)
-                if not data:
-                    logging.warning("No data for client %s", client_id)
-                    continue
-                parsed = _parse_consumption_results(data)
-
-                # Fetch location for client
-                loc_rows = _query_db(
-                    db_conf, "SELECT location_id FROM locations WHERE client_id = %s;", [client_id]
-                )
-                if not loc_rows:
-                    logging.warning("No location for client %s", client_id)
-                    continue
-                location_id = loc_rows[0][0]
-
-                # Write created rows to tsdb
-                rows = _create_rows(parsed, client_id, location_id, mpan)
-                if rows:
-                    logging.info("Writing rows to database....")
-                    _query_db(
-                        db_conf,
-                        """
-                        INSERT INTO main
-                          (time, client_id, location_id, metric, value, gateway, sensor, note)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                        ON CONFLICT (time, client_id, location_id, metric, gateway, sensor) DO NOTHING;
-                        """,
-                        rows,
-                        fetch=False,
-                        many=True,
-                    )
-                    logging.info("Inserted %d rows for client %s", len(rows), client_id)
-            except Exception as e:
-                logging.exception("Client %s failed: %s", client_id, e)
+        # Fetch every client's API key in parallel up front
+        api_keys = _get_secrets([c[3] for c in clients], strict=False)
+
+        # Skip clients that can't be processed
+        jobs = []
+        for client_id, mpan, serial, secret_name, location_id in clients:
+            api_key = api_keys.get(secret_name)
+            if not api_key:
+                logging.warning("No API key for client %s", client_id)
+                continue
+            if not location_id:
+                logging.warning("No location for client %s", client_id)
+                continue
+            jobs.append((client_id, mpan, serial, location_id, api_key, period_from, period_to))
+
+        # Clients are independent HTTP I/O, fetch them concurrently on the shared session.
+        # Rows for every client are written in one COPY afterwards
+        all_rows = []
+        if jobs:
+            with ThreadPoolExecutor(max_workers=min(len(jobs), 8)) as ex:
+                for rows in ex.map(lambda job: _get_client_rows(*job), jobs):
+                    all_rows.extend(rows)
+
+        # Write all clients' rows to tsdb. Time ordered so inserts land on the newest chunks
+        if all_rows:
+            all_rows.sort(key=lambda r: r[0])
+            logging.info("Writing rows to database....")
+            if _copy_rows_to_tsdb(db_conf, all_rows, conn=conn):
+                logging.info("Inserted %d rows for %d clients", len(all_rows), len(clients))
 
     except Exception as e:
         logging.exception("Startup failure in timer handler: %s", e)
+    finally:
+        if conn is not None:
+            conn.close()
 
     logging.info("Timer run complete.")
@@ -109,13 +109,16 @@ def query_db(query, params=None, fetch=True, many=False):
         logging.exception(f"Database operation failed: {e}")
         return [] if fetch else False
 
-#Get active Octopus Client info from tsdb
+#Get active Octopus Client info and location from tsdb
 def get_client_config():
     logging.info("Getting client information from tsdb")
     query = """
-    SELECT client_id, mpan, serial, api_key_secret_name
-    FROM octopus_energy_config
-    WHERE is_active = true;
+    SELECT c.client_id, c.mpan, c.serial, c.api_key_secret_name,
+        (SELECT l.location_id FROM locations l
+         WHERE l.client_id = c.client_id
+         ORDER BY l.location_id LIMIT 1) AS location_id
+    FROM octopus_energy_config c
+    WHERE c.is_active = true;
     """
     result = query_db(query)
     logging.info(result)
@@ -124,21 +127,6 @@ def get_client_config():
     else:
         raise ValueError(f"No active clients found.")
     
-def get_client_location(client_id):
-    logging.info(f"Getting location ID for {client_id}...")
-    query = """
-    SELECT location_id
-    FROM locations
-    WHERE client_id = %s;
-    """
-    result = query_db(query, [client_id])
-    location_id = result[0][0]
-    logging.info(location_id)
-    if location_id:
-        return location_id
-    else:
-        raise ValueError(f"No location for {client_id} found.")
-    
 #Writes row data to timescale
 def write_to_tsdb(rows):
     logging.info(f"Writing to database....")
@@ -183,8 +171,9 @@ def main():
     for client in clients:
         try:
             #Extract client details from response
-            client_id, MPAN, SERIAL, secret_name = client
-            location_id = get_client_location(client_id)
+            client_id, MPAN, SERIAL, secret_name, location_id = client
+            if not location_id:
+                raise ValueError(f"No location for {client_id} found.")
             #Get API_KEY based on name stored in tsdb
             #Actual API_KEY secret stored in Key Vault
             API_KEY = get_secret(secret_name)
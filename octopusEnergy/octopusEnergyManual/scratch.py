@@ -1,4 +1,4 @@
-import json
+import orjson
 import logging
 from datetime import datetime, timezone
 
@@ -6,6 +6,9 @@ logging.basicConfig(level=logging.INFO)
 
 def _to_naive_utc(ts: str) -> str:
     """Convert ISO8601 string (with Z or offset) to naive UTC 'YYYY-MM-DDTHH:MM:SS'."""
+    # Fast path: already UTC, the answer is just the date/time prefix
+    if len(ts) == 20 and ts[19] == 'Z' or len(ts) == 25 and ts.endswith('+00:00'):
+        return ts[:19]
     # Normalize Z to +00:00 so fromisoformat can parse it
     if ts.endswith('Z'):
         ts = ts.replace('Z', '+00:00')
@@ -46,8 +49,8 @@ def parse_consumption_results(consumption_json):
     return out
 
 # Example usage with your file:
-with open('response.json') as f:
-    d = json.load(f)
+with open('response.json', 'rb') as f:
+    d = orjson.loads(f.read())
 
 rows = parse_consumption_results(d)
 print(rows[:3])  # peek at first few
@@ -1,12 +1,28 @@
-import logging, pg8000, requests, pytz, time, string
-from datetime import timedelta, datetime as dt
-from io import StringIO
+import logging, pg8000, requests, time, string, orjson, os, tempfile
+from datetime import timedelta, timezone, datetime as dt
+from itertools import chain
+from pathlib import Path
 from functools import wraps
 from contextlib import contextmanager
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 session = requests.Session()
-session.mount("https://", requests.adapters.HTTPAdapter(max_retries=3))
+session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=3))
+
+SMAPPEE_API = "https://app1pub.smappee.net/dev/v3"
+
+# Upper bound on concurrent Smappee API requests per helper
+MAX_WORKERS = 16
+
+# Rows per COPY data message sent to Postgres
+COPY_CHUNK_ROWS = 1000
+
+# Metering configuration only changes when a monitor is (re)installed, so each slid's
+# index map is cached in /tmp for a day. Cleared when the instance recycles
+METERING_CACHE_PATH = Path(tempfile.gettempdir()) / "smappee_metering.json"
+METERING_CACHE_TTL_SECS = 24 * 60 * 60
+_metering_cache = None
 
 METRIC = 'electricity'
 
@@ -21,7 +37,7 @@ def log_timing(name=None):
                 return func(*args, **kwargs)
             finally:
                 elapsed = (time.perf_counter() - start) * 1000
-                logging.info(f"⏱ {label} took {elapsed:.2f} ms")
+                logging.info("⏱ %s took %.2f ms", label, elapsed)
         return wrapper
     return decorator
 
@@ -33,43 +49,83 @@ def timing_block(label: str):
         yield
     finally:
         elapsed = (time.perf_counter() - start) * 1000
-        logging.info(f"   ↳ {label} took {elapsed:.2f} ms")
+        logging.info("   ↳ %s took %.2f ms", label, elapsed)
+
+# GETs every url in {slid: url} concurrently over the shared keep-alive session.
+# Returns (slid, response) pairs; requests that fail outright are logged and dropped
+def _batch_get(urls: dict, HEADERS) -> list:
+    if not urls:
+        return []
+    responses = []
+    with ThreadPoolExecutor(max_workers=min(len(urls), MAX_WORKERS)) as ex:
+        futures = {}
+        for slid, url in urls.items():
+            logging.debug("Fetching data from %s", url)
+            futures[ex.submit(session.get, url, headers=HEADERS, timeout=10)] = slid
+        for future in as_completed(futures):
+            slid = futures[future]
+            try:
+                responses.append((slid, future.result()))
+            except requests.RequestException as e:
+                logging.warning("⚠️ Failed to fetch data for %s: %s", slid, e)
+    return responses
+
+def _connect_db(db_conf: dict):
+    return pg8000.connect(
+        host=db_conf["host"],
+        database=db_conf["name"],
+        user=db_conf["user"],
+        password=db_conf["password"],
+        port=int(db_conf["port"]),
+        application_name="smappee_ingest"
+    )
+
+# Yields conn when the caller passes one (and leaves closing it to them), otherwise a one-off connection.
+# A failed statement is rolled back so a shared connection stays usable
+@contextmanager
+def _db_connection(db_conf: dict, conn=None):
+    connection = conn or _connect_db(db_conf)
+    try:
+        yield connection
+    except Exception:
+        try:
+            connection.rollback()
+        except Exception:
+            pass
+        raise
+    finally:
+        if conn is None:
+            connection.close()
 
 @log_timing()
-def _query_db(db_conf: dict, query, params=None, fetch=True, many=False):
+def _query_db(db_conf: dict, query, params=None, fetch=True, many=False, conn=None):
     try:
-        with pg8000.connect(
-            host=db_conf["host"],
-            database=db_conf["name"],
-            user=db_conf["user"],
-            password=db_conf["password"],
-            port=int(db_conf["port"]),
-            application_name="smappee_ingest"
-        ) as connection:
+        with _db_connection(db_conf, conn) as connection:
             with connection.cursor() as cursor:
                 if many:
                     cursor.executemany(query, params)
                 else:
                     cursor.execute(query, params or [])
-                if fetch:
-                    return cursor.fetchall()
+                records = cursor.fetchall() if fetch else None
+            # Reads are committed too, so a shared conn isn't left idle in a transaction while the caller works
             connection.commit()
+            return records
     except Exception as e:
         logging.exception("Database operation failed: %s", e)
         return [] if fetch else False
     
 # Get service_location, client, location info
 @log_timing()
-def _get_service_locations(db_conf):
+def _get_service_locations(db_conf, conn=None):
     logging.info("1. Getting service locations")
     query = """
         select sl.service_loc_id, sl.client_id, l.location_id
         from service_locations sl
         left join locations l on l.location_id = sl.location_id
     """
-    records = _query_db(db_conf, query, params=None, fetch=True, many=False)
-    logging.info(records)
-    logging.info(f"Fetched {len(records)} service locations from the database")
+    records = _query_db(db_conf, query, params=None, fetch=True, many=False, conn=conn)
+    logging.debug(records)
+    logging.info("Fetched %s service locations from the database", len(records))
     if not records:
         logging.warning("No service locations found in the database")
         return {}
@@ -78,27 +134,54 @@ def _get_service_locations(db_conf):
             for rec in records if rec
     }
 
+# {str(slid): {"fetched_at": epoch, "pairs": [[consumptionIndex, name], ...]}}, read from /tmp once per worker
+def _load_metering_cache() -> dict:
+    global _metering_cache
+    if _metering_cache is None:
+        try:
+            _metering_cache = orjson.loads(METERING_CACHE_PATH.read_bytes())
+        except (OSError, orjson.JSONDecodeError):
+            _metering_cache = {}
+    return _metering_cache
+
+def _write_metering_cache(cache: dict) -> None:
+    tmp = METERING_CACHE_PATH.with_suffix(".tmp")
+    try:
+        tmp.write_bytes(orjson.dumps(cache))
+        os.replace(tmp, METERING_CACHE_PATH)  # atomic on same filesystem
+    except OSError as e:
+        logging.warning("Could not write metering cache %s: %s", METERING_CACHE_PATH, e)
+
 # Queries metering configuration for each service location to get the sensor index. This is used to match the sensor name to the consumption values
 # Gets the index and the sensor name for each service location
 @log_timing()
 def _get_index_for_sensors(service_locations, HEADERS):
     logging.info("2. Getting index for sensors")
     sensor_index = {}
+    cache = _load_metering_cache()
+    now = time.time()
 
+    # Only fetch locations with no cached index map, or one older than the TTL
+    urls = {}
     for slid in service_locations:
-        url = f"https://app1pub.smappee.net/dev/v3/servicelocation/{slid}/meteringconfiguration"
-        resp = session.get(url, headers=HEADERS, timeout=10)
+        cached = cache.get(str(slid))
+        if cached and now - cached["fetched_at"] < METERING_CACHE_TTL_SECS:
+            sensor_index[slid] = OrderedDict((idx, name) for idx, name in cached["pairs"])
+        else:
+            urls[slid] = f"{SMAPPEE_API}/servicelocation/{slid}/meteringconfiguration"
+    logging.info("Using cached metering config for %s service locations", len(sensor_index))
 
+    for slid, resp in _batch_get(urls, HEADERS):
         if resp.status_code != 200:
-            logging.error(f"Failed to fetch data for {slid}: {resp.status_code}")
+            logging.error("Failed to fetch data for %s: %s", slid, resp.status_code)
             continue
 
-        data = resp.json()
+        data = orjson.loads(resp.content)
         measurements = data.get("measurements", [])
 
         # Skip parent locations
         if measurements and "serviceLocationId" in measurements[0]:
-            logging.error(f"Parent location, serviceLocationId in measurements for {slid}")
+            logging.error("Parent location, serviceLocationId in measurements for %s", slid)
             continue
 
         # Collect (consumptionIndex, name) pairs
@@ -114,9 +197,12 @@ def _get_index_for_sensors(service_locations, HEADERS):
         index_map = OrderedDict(pairs)
 
         sensor_index[slid] = index_map
+        cache[str(slid)] = {"fetched_at": now, "pairs": pairs}
 
-    logging.info(sensor_index)  # this will now show OrderedDicts in index order
-    logging.info(f"Processed {len(sensor_index)} service locations for sensor index")
+    if urls:
+        _write_metering_cache(cache)
+    logging.debug(sensor_index)  # this will now show OrderedDicts in index order
+    logging.info("Processed %s service locations for sensor index", len(sensor_index))
     return sensor_index
 
 # Gets unique sensor names from the sensor index mapping. Possible to have single or multi-phase sensors in the index
@@ -125,69 +211,74 @@ def _get_index_for_sensors(service_locations, HEADERS):
 @log_timing()
 def _get_unique_sensor_names(sensor_index):
     logging.info("3. Getting unique sensor names (order-preserving)")
-    ordered_unique = OrderedDict()
-
-    # deterministic traversal across locations (adjust if you prefer insertion order)
-    for slid in sorted(sensor_index.keys()):
-        idx_map = sensor_index[slid]  # this is an OrderedDict sorted by consumptionIndex
-        for name in idx_map.values():
-            if name not in ordered_unique:
-                ordered_unique[name] = None
-
-    names = list(ordered_unique.keys())
-    logging.info(f"Processed {len(names)} unique sensor names.")
-    logging.info(names)  # keep as list; avoid sets/sorted() which wreck order
+
+    # Order matters: new gateways number their sensors by position in this list.
+    # Locations are walked in slid order (sensor_index is filled as responses complete),
+    # each index map is already in consumptionIndex order; dict.fromkeys dedups keeping first-seen order
+    names = list(dict.fromkeys(
+        name
+        for slid in sorted(sensor_index)
+        for name in sensor_index[slid].values()
+    ))
+    logging.info("Processed %s unique sensor names.", len(names))
+    logging.debug(names)  # keep as list; avoid sets/sorted() which wreck order
     return names
 
 # Gets consumption data per service location id
-# Rolling 30 minute window from current time
+# Rolling 24 hour window, computed per call so warm workers never reuse a stale window
 @log_timing()
 def _get_consumption_data(service_locations, HEADERS):
     logging.info("4. Getting consumption data")
 
-    # Rolling 30 minute window from current time
-    now = dt.now(pytz.utc)
+    # Rolling 24 hour window from current time
+    now = dt.now(timezone.utc)
     time_to   = int(now.timestamp())
     time_from = int((now - timedelta(hours=24)).timestamp())
     consumption_data_map = {}
-    
+
     with timing_block("Get consumption data"):
-        for slid in service_locations:
-            url = f"https://app1pub.smappee.net/dev/v3/servicelocation/{slid}/consumption?aggregation=1&from={time_from}&to={time_to}"
-            logging.info(f"Fetching data from {url}")
-            response = session.get(url, headers=HEADERS, timeout=10)
+        urls = {
+            slid: f"{SMAPPEE_API}/servicelocation/{slid}/consumption?aggregation=1&from={time_from}&to={time_to}"
+            for slid in service_locations
+        }
+        for slid, response in _batch_get(urls, HEADERS):
             if response.status_code != 200:
-                logging.warning(f"⚠️ Failed to fetch data for {slid}: {response.status_code}")
+                logging.warning("⚠️ Failed to fetch data for %s: %s", slid, response.status_code)
                 continue
             # Gets consumption data for the service location slid
-            data = response.json().get("consumptions", [])
+            data = orjson.loads(response.content).get("consumptions", [])
             # Get only entries with active power values
             filtered = [entry for entry in data if any(p is not None for p in entry.get("active", []))]
             if filtered:
                 consumption_data_map[slid] = filtered
-    logging.info(f"✅ Processed {len(consumption_data_map)} service locations with consumption data")
+    logging.info("✅ Processed %s service locations with consumption data", len(consumption_data_map))
     return consumption_data_map     
 
+# Gateway labels in spreadsheet-column order: A..Z, AA..ZZ. Covers every realistic index without the divmod loop
+_GATEWAY_LABELS = list(string.ascii_uppercase) + [a + b for a in string.ascii_uppercase for b in string.ascii_uppercase]
+
+def _new_gateway_id(n: int) -> str:
+    n = int(n)
+    if n < len(_GATEWAY_LABELS):
+        return _GATEWAY_LABELS[n]
+    letters = []
+    while True:
+        n, rem = divmod(n, 26)
+        letters.append(string.ascii_uppercase[rem])
+        if n == 0:
+            break
+        n -= 1
+    return ''.join(reversed(letters))
+
 # Gets gateway and sensor information for each service location. Uses the unique sensor names from sensor set with the sensor index.
 @log_timing()
-def _get_gateway_sensor_info(db_conf, service_locations, sensor_index, sensor_set):
+def _get_gateway_sensor_info(db_conf, service_locations, sensor_index, sensor_set, conn=None):
     logging.info("5. Fetching gateway and sensor information for service locations...")
     sensor_gateway_map = {}
 
     # Tracks next created gateway index per service locations client_id/location_id
     new_gateway_counter = {}
 
-    def new_gateway_id(n: int) -> str:
-        n = int(n)
-        letters = []
-        while True:
-            n, rem = divmod(n, 26)
-            letters.append(string.ascii_uppercase[rem])
-            if n == 0:
-                break
-            n -= 1
-        return ''.join(reversed(letters))
-
     if not isinstance(service_locations, dict):
         logging.error("⚠️ Service locations should be a dictionary")
         return {}
@@ -197,41 +288,52 @@ def _get_gateway_sensor_info(db_conf, service_locations, sensor_index, sensor_se
         return {}
 
     #TODO: Check if sensor_index or sensor_set should be used, add slid to sensor_set
+    # Service locations that can be mapped, keyed to their (client_id, location_id)
+    mapped = {}
     for slid, info in service_locations.items():
         if slid not in sensor_index:
-            logging.warning(f"⚠️ Service location {slid} not in sensor index")
+            logging.warning("⚠️ Service location %s not in sensor index", slid)
             continue
 
         client_id = info.get("client_id")
         location_id = info.get("location_id")
         if not client_id or not location_id:
-            logging.warning(f"⚠️ Service location {slid} has no client or location id in database.")
+            logging.warning("⚠️ Service location %s has no client or location id in database.", slid)
             continue
+        mapped[slid] = (client_id, location_id)
+
+    if not mapped:
+        return sensor_gateway_map
+
+    # Query existing gateway/sensor rows for these notes in the last day, for every client/location in one round-trip
+    pairs = list(dict.fromkeys(mapped.values()))
+    pair_placeholders = ', '.join(['(%s, %s)'] * len(pairs))
+    query = f'''
+        SELECT DISTINCT client_id, location_id, gateway, sensor, note
+        FROM main
+        WHERE (client_id, location_id) IN ({pair_placeholders})
+          AND note = ANY(%s)
+          AND time >= current_timestamp - INTERVAL '1 day';
+    '''
+    parameters = [v for pair in pairs for v in pair] + [list(sensor_set)]
+    existing = {}
+    for rec in _query_db(db_conf, query, parameters, conn=conn):
+        if rec:
+            existing.setdefault((rec[0], rec[1]), []).append(
+                {"sensor": rec[3], "gateway": rec[2], "sensor_name": rec[4]}
+            )
 
-        # Query existing gateway/sensor rows for these notes in the last day
-        placeholders = ', '.join(['%s'] * len(sensor_set))
-        query = f'''
-            SELECT DISTINCT gateway, sensor, note
-            FROM main
-            WHERE client_id = %s
-              AND location_id = %s
-              AND note IN ({placeholders})
-              AND time >= current_timestamp - INTERVAL '1 day';
-        '''
-        parameters = [client_id, location_id] + list(sensor_set)
-        records = _query_db(db_conf, query, parameters)
+    for slid, key in mapped.items():
+        records = existing.get(key)
+        client_id, location_id = key
 
         if records:
             # Use the data from tsdb
-            sensor_gateway_map[slid] = [
-                {"sensor": rec[1], "gateway": rec[0], "sensor_name": rec[2]}
-                for rec in records if rec
-            ]
+            sensor_gateway_map[slid] = list(records)
         else:
             # No records found: create a new gateway for this client/location and map all sensors
-            key = (client_id, location_id)
             next_idx = new_gateway_counter.get(key, 0)
-            gateway_label = new_gateway_id(next_idx)
+            gateway_label = _new_gateway_id(next_idx)
             new_gateway_counter[key] = next_idx + 1
 
             # Adds sensor_id, gateway, sensor name to sensor_gateway_map for each sensor in sensor_set
@@ -240,68 +342,97 @@ def _get_gateway_sensor_info(db_conf, service_locations, sensor_index, sensor_se
                 for i, sname in enumerate(sensor_set)
             ]
             logging.info(
-                f"Created gateway '{gateway_label}' for client_id {client_id} & location_id {location_id} "
-                f"for service_location_id {slid} with {len(sensor_set)} sensors (IDs 1..{len(sensor_set)})."
+                "Created gateway '%s' for client_id %s & location_id %s "
+                "for service_location_id %s with %d sensors (IDs 1..%d).",
+                gateway_label, client_id, location_id, slid, len(sensor_set), len(sensor_set)
             )
 
-    logging.info(f"Processed {len(sensor_gateway_map)} service locations for gateway and sensor information")
+    logging.info("Processed %s service locations for gateway and sensor information", len(sensor_gateway_map))
     return sensor_gateway_map
 
-# Sum the active power values for each sensor name
-def sum_active_power_per_sensor(active_power, index_mapping):
-    if not active_power:
-        return {}
-    summed_active_power = {}
-    # For each index and sensor name in the index mapping, sum the active power values
+# Index gateway_sensor_info as {slid: {sensor_name: (gateway, sensor)}} so row assembly is a dict lookup.
+# First entry wins for a repeated sensor name, matching the old linear scan
+def _reverse_sensor_map(gateway_sensor_info):
+    lookup = {}
+    for slid, sensors in gateway_sensor_info.items():
+        by_name = lookup[slid] = {}
+        for s in sensors:
+            by_name.setdefault(s["sensor_name"], (s["gateway"], s["sensor"]))
+    return lookup
+
+# Group consumption indexes by sensor name (one per phase) once per service location.
+# Returns [(sensor_name, (index, ...)), ...] in index order
+def _group_channels(index_mapping):
+    groups = {}
     for consumption_index, sensor_name in index_mapping.items():
+        groups.setdefault(sensor_name, []).append(consumption_index)
+    return [(sensor_name, tuple(indexes)) for sensor_name, indexes in groups.items()]
 
-        P_values = [entry[consumption_index] if consumption_index < len(entry) and entry[consumption_index] is not None else 0 for entry in active_power]
-        summed_value = round(sum(P_values), 4)
-
-        # Sums values of active power for each sensor name
-        if sensor_name in summed_active_power:
-            summed_active_power[sensor_name] += summed_value
-        else:
-            summed_active_power[sensor_name] = summed_value
+# Sum the active power values of one consumption entry for each sensor name.
+# Missing or None phases count as 0, so every sensor still gets a value
+def sum_active_power_per_sensor(active_row, channel_groups):
+    n = len(active_row)
+    summed_active_power = {}
+    # For each sensor name, sum the active power values of all its phases
+    for sensor_name, indexes in channel_groups:
+        summed_value = 0
+        for consumption_index in indexes:
+            if consumption_index < n:
+                value = active_row[consumption_index]
+                if value is not None:
+                    summed_value += round(value, 4)
+        summed_active_power[sensor_name] = summed_value
 
     return summed_active_power
 
+# Joins consumption entries with the sensor index and gateway/sensor info.
+# Yields finished rows in COPY column order: (time, sensor, value, gateway, client_id, location_id, note, metric)
+def _assemble_rows(consumption_data_map, sensor_index, service_locations, gateway_sensor_info):
+    sensor_lookup = _reverse_sensor_map(gateway_sensor_info)
+    for slid, entries in consumption_data_map.items():
+        if slid not in sensor_index:
+            logging.warning("⚠️ Sensor index missing for %s, skipping...", slid)
+            continue
+        slid_sensors = sensor_lookup.get(slid, {})
+        channel_groups = _group_channels(sensor_index[slid])
+        client_id = service_locations.get(slid, {}).get("client_id", "")
+        location_id = service_locations.get(slid, {}).get("location_id", "")
+
+        for entry in entries:
+            timestamp = dt.fromtimestamp(entry["timestamp"] / 1000, timezone.utc)
+            summed = sum_active_power_per_sensor(entry["active"], channel_groups)
+
+            for sensor_name, power_value in summed.items():
+                gateway, sensor_id = slid_sensors.get(sensor_name, ("", ""))
+
+                if all([client_id, location_id, gateway, sensor_id]):
+                    yield (
+                        timestamp,          # time (timestamptz)
+                        sensor_id,          # sensor (text)
+                        round(power_value, 4), # value (numeric/float)
+                        gateway,            # gateway (text)
+                        client_id,          # client_id (text/int)
+                        location_id,        # location_id (text/int)
+                        sensor_name,        # note (text)
+                        METRIC,             # metric (text)
+                    )
+                else:
+                    logging.warning("⚠️ Missing data for %s: %s, %s, %s, %s, %s", slid, client_id, location_id, power_value, gateway, sensor_id)
+
 # Assemble rows for CSV, modify to write to tsdb
 @log_timing()
 def _generate_insert(consumption_data_map, sensor_index, service_locations, gateway_sensor_info):
         logging.info("Generating insert statment")
-        rows = []
-        for slid, entries in consumption_data_map.items():
-            if slid not in sensor_index:
-                continue
-            for entry in entries:
-                timestamp = dt.fromtimestamp(entry["timestamp"] / 1000, pytz.UTC)
-                summed = sum_active_power_per_sensor([entry["active"]], sensor_index[slid])
-                for sensor_name, power_value in summed.items():
-                    client_id = service_locations.get(slid, {}).get("client_id", "")
-                    location_id = service_locations.get(slid, {}).get("location_id", "")
-                    gateway = sensor_id = ""
-                    for s in gateway_sensor_info.get(slid, []):
-                        if s["sensor_name"] == sensor_name:
-                            gateway, sensor_id = s["gateway"], s["sensor"]
-                            break
-                    sensor_note = f"{sensor_name}"
-                    if all([client_id, location_id, gateway, sensor_id]):
-                        rows.append([timestamp, client_id, location_id, METRIC, round(power_value,4), gateway, sensor_id, sensor_note])
-                    else:
-                        logging.warning(f"⚠️ Missing data for {slid}: {client_id}, {location_id}, {power_value}, {gateway}, {sensor_id}")
+        value_lines = [
+            f"('{r[0]:%Y-%m-%d %H:%M:%S}', '{r[1]}', '{r[2]}', '{r[3]}', '{r[4]}', '{r[5]}', '{r[6]}', '{r[7]}')"
+            for r in _assemble_rows(consumption_data_map, sensor_index, service_locations, gateway_sensor_info)
+        ]
 
         sql_query = (
             "INSERT INTO test_table_main (time, sensor, value, gateway, client_id, location_id, note, metric) "
             "VALUES "
         )
 
-        value_lines = []
-        for row in rows:
-            formatted_time = row[0].strftime("%Y-%m-%d %H:%M:%S")
-            values = f"('{formatted_time}', '{row[6]}', '{row[4]}', '{row[5]}', '{row[1]}', '{row[2]}', '{row[7]}', '{row[3]}')"
-            value_lines.append(values)
-
         values_sql = ",\n".join(value_lines)
 
         final_sql = (
@@ -309,76 +440,39 @@ def _generate_insert(consumption_data_map, sensor_index, service_locations, gate
             "ON CONFLICT (time, client_id, location_id, metric, gateway, sensor) DO NOTHING;"
         )
         logging.info("Generated insert statement")
-        # Write to file for local testing and verification
-        file = f"tsdb_insert{dt.now().strftime('%Y-%m-%d')}.txt"
-        with open(file, "w") as f:
-            f.write(final_sql)
-        logging.info(f"SQL insert statement written to {file}")
+        # Write to file for local testing and verification. Off by default, set SMAPPEE_DUMP_SQL to enable
+        if os.getenv("SMAPPEE_DUMP_SQL"):
+            file = f"tsdb_insert{dt.now().strftime('%Y-%m-%d')}.txt"
+            with open(file, "w") as f:
+                f.write(final_sql)
+            logging.info("SQL insert statement written to %s", file)
+
+# Formats rows as COPY text lines and yields them in chunks of COPY_CHUNK_ROWS,
+# so the full TSV is never built in memory. \N would mark NULLs, but rows never contain any
+def _iter_copy_chunks(rows, chunk_rows=COPY_CHUNK_ROWS):
+    lines = []
+    for r in rows:
+        lines.append(f"{r[0].isoformat()}\t{r[1]}\t{r[2]}\t{r[3]}\t{r[4]}\t{r[5]}\t{r[6]}\t{r[7]}\n")
+        if len(lines) >= chunk_rows:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
 
 @log_timing()
-def _write_to_tsdb(db_conf, sensor_index, service_locations, gateway_sensor_info, consumption_data_map):
+def _write_to_tsdb(db_conf, sensor_index, service_locations, gateway_sensor_info, consumption_data_map, conn=None):
     logging.info("Writing to database via COPY -> INSERT ON CONFLICT")
-    rows = []
-
-    for slid, entries in consumption_data_map.items():
-        if slid not in sensor_index:
-            logging.warning(f"⚠️ Sensor index missing for {slid}, skipping...")
-            continue
-
-        for entry in entries:
-            timestamp = dt.fromtimestamp(entry["timestamp"] / 1000, pytz.UTC)
-            summed = sum_active_power_per_sensor([entry["active"]], sensor_index[slid])
-
-            for sensor_name, power_value in summed.items():
-                client_id = service_locations.get(slid, {}).get("client_id", "")
-                location_id = service_locations.get(slid, {}).get("location_id", "")
-                gateway = sensor_id = ""
+    rows = _assemble_rows(consumption_data_map, sensor_index, service_locations, gateway_sensor_info)
 
-                for s in gateway_sensor_info.get(slid, []):
-                    if s["sensor_name"] == sensor_name:
-                        gateway, sensor_id = s["gateway"], s["sensor"]
-                        break
-
-                if all([client_id, location_id, gateway, sensor_id]):
-                    rows.append([
-                        timestamp,          # time (timestamptz)
-                        sensor_id,          # sensor (text)
-                        round(power_value, 4), # value (numeric/float)
-                        gateway,            # gateway (text)
-                        client_id,          # client_id (text/int)
-                        location_id,        # location_id (text/int)
-                        sensor_name,        # note (text)
-                        METRIC,             # metric (text)
-                    ])
-                else:
-                    logging.warning(f"Missing data for {slid}: {client_id}, {location_id}, {power_value}, {gateway}, {sensor_id}")
-
-    if not rows:
+    # Peek so an empty run skips the connection work; rows are otherwise consumed lazily by COPY
+    first = next(rows, None)
+    if first is None:
         logging.warning("No rows to write to database, exiting...")
         return
 
-    logging.info(f"Prepared {len(rows)} rows")
-
-    # Build a CSV/TSV stream for COPY, Using TEXT tab-delimited
-    with timing_block("Streaming"):
-        buf = StringIO()
-        for r in rows:
-            ts = r[0].isoformat()  #timestamp to iso
-            # Use \N for NULLs if needed, should never be NULLs
-            line = f"{ts}\t{r[1]}\t{r[2]}\t{r[3]}\t{r[4]}\t{r[5]}\t{r[6]}\t{r[7]}\n"
-            buf.write(line)
-        buf.seek(0)
-
     try:
         with timing_block("Copying to temp"):
-            with pg8000.connect(
-                host=db_conf["host"],
-                database=db_conf["name"],
-                user=db_conf["user"],
-                password=db_conf["password"],
-                port=int(db_conf["port"]),
-                application_name="smappee_ingest"
-            ) as conn:
+            with _db_connection(db_conf, conn) as conn:
                 cur = conn.cursor()
                 # Faster commits for ingest; acceptable tiny durability risk.
                 cur.execute("SET LOCAL synchronous_commit = off;")
@@ -390,13 +484,14 @@ def _write_to_tsdb(db_conf, sensor_index, service_locations, gateway_sensor_info
                     ON COMMIT DROP;
                 """)
 
-                # COPY from in-memory stream into the temp table.
+                # COPY rows into the temp table as they are assembled.
                 # Using TEXT format with tabs; tell Postgres we're sending from stdin
                 cur.execute(
                     "COPY _ingest_main (time, sensor, value, gateway, client_id, location_id, note, metric) "
                     "FROM stdin WITH (FORMAT text)",
-                    stream=buf
-                )  # pg8000 streams the data to COPY. :contentReference[oaicite:1]{index=1}
+                    stream=_iter_copy_chunks(chain((first,), rows))
+                )  # pg8000 sends each chunk from the iterable as COPY data
+                logging.info("Copied %s rows", cur.rowcount)
 
                 # Dedup into main table with ON CONFLICT DO NOTHING.
                 # Reduces time to insert data to table
@@ -1,10 +1,13 @@
 # 25/09/25 10:30  Updated application name & ingest table
 
 import logging
+import time
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import azure.functions as func
 from pathlib import Path
 import tempfile
-from helpers.helpers import _get_service_locations,_get_index_for_sensors,_get_unique_sensor_names,_get_consumption_data,_get_gateway_sensor_info,_generate_insert,_write_to_tsdb, log_timing
+from helpers.helpers import _get_service_locations,_get_index_for_sensors,_get_unique_sensor_names,_get_consumption_data,_get_gateway_sensor_info,_generate_insert,_write_to_tsdb, _connect_db, log_timing
 from helpers.token_refresh import _get_active_token, clear_token_store
 
 from azure.keyvault.secrets import SecretClient
@@ -12,32 +15,53 @@ from azure.identity import DefaultAzureCredential
 
 app = func.FunctionApp()
 
+KV_URI = "https://uaeapicredentials.vault.azure.net/"
+
+# Key Vault client is created once per worker; no network until the first get_secret call
+@lru_cache(maxsize=None)
+def _get_kv_client() -> SecretClient:
+    return SecretClient(vault_url=KV_URI, credential=DefaultAzureCredential())
+
+# Secrets are cached per worker so warm invocations skip Key Vault, and re-read after SECRET_TTL_SECS
+# so a rotated password is still picked up without a restart
+SECRET_TTL_SECS = 6 * 60 * 60
+_secret_cache = {}
+
+def _get_secret(name: str) -> str:
+    cached = _secret_cache.get(name)
+    if cached and time.monotonic() - cached[1] < SECRET_TTL_SECS:
+        return cached[0]
+    value = _get_kv_client().get_secret(name).value
+    _secret_cache[name] = (value, time.monotonic())
+    return value
+
 @app.timer_trigger(schedule="0 */5 * * * *", arg_name="myTimer", run_on_startup=False,
               use_monitor=False) 
 @log_timing()
 def uaeSmappeeIngest(myTimer: func.TimerRequest) -> None:
     logging.info("Starting UAE Smappee ingest")
+    conn = None
     try:
         logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-        KV_URI = "https://uaeapicredentials.vault.azure.net/"
-        credential = DefaultAzureCredential()
-        kv = SecretClient(vault_url=KV_URI, credential=credential)
 
         # DB config
         db_conf = {
-            "password": kv.get_secret("tsdbPassword").value,
-            "port":     kv.get_secret("tsdbPort").value,
-            "host":     kv.get_secret("tsdbHost").value,
-            "name":     kv.get_secret("tsdbName").value,
-            "user":     kv.get_secret("tsdbUser").value,
+            "password": _get_secret("tsdbPassword"),
+            "port":     _get_secret("tsdbPort"),
+            "host":     _get_secret("tsdbHost"),
+            "name":     _get_secret("tsdbName"),
+            "user":     _get_secret("tsdbUser"),
         }
 
+        # One connection for every query in this run
+        conn = _connect_db(db_conf)
+
         sm_conf = {
             "grant_type": "password",
-            "client_id": kv.get_secret("uaeSmappeeClientID").value,
-            "client_secret": kv.get_secret("uaeSmappeeClientSecret").value,
-            "username": kv.get_secret("uaeSmappeeUsername").value,
-            "password": kv.get_secret("uaeSmappeePassword").value,
+            "client_id": _get_secret("uaeSmappeeClientID"),
+            "client_secret": _get_secret("uaeSmappeeClientSecret"),
+            "username": _get_secret("uaeSmappeeUsername"),
+            "password": _get_secret("uaeSmappeePassword"),
         }
         
 
@@ -51,19 +75,24 @@ def uaeSmappeeIngest(myTimer: func.TimerRequest) -> None:
         TOKEN_STORE_PATH = Path(tempfile.gettempdir()) / "uae_smartflow_tokens.json"
 
         #Get service locations, client ID and location ID from tsdb 
-        service_locations = _get_service_locations(db_conf) 
+        service_locations = _get_service_locations(db_conf, conn=conn) 
 
-        #Get index for sensors per sensor location
-        sensor_index = _get_index_for_sensors(service_locations, HEADERS)
+        # Consumption data only needs the service locations, so fetch it in the background
+        # while the sensor index and gateway lookups run
+        with ThreadPoolExecutor(max_workers=1) as ex:
+            #Get consumption data for and maps to each service location
+            consumption_future = ex.submit(_get_consumption_data, service_locations, HEADERS)
 
-        #Get unique sensor names from the index
-        sensor_set = _get_unique_sensor_names(sensor_index)
-        
-        #Get consumption data for and maps to each service location
-        consumption_data_map = _get_consumption_data(service_locations, HEADERS)
+            #Get index for sensors per sensor location
+            sensor_index = _get_index_for_sensors(service_locations, HEADERS)
 
-        ## Get gateway and sensor information for each service location from tsdb
-        gateway_sensor_info = _get_gateway_sensor_info(db_conf, service_locations, sensor_index, sensor_set)
+            #Get unique sensor names from the index
+            sensor_set = _get_unique_sensor_names(sensor_index)
+
+            ## Get gateway and sensor information for each service location from tsdb
+            gateway_sensor_info = _get_gateway_sensor_info(db_conf, service_locations, sensor_index, sensor_set, conn=conn)
+
+            consumption_data_map = consumption_future.result()
 
         # Assemble CSV to create insert statements for tsdb
         #_generate_insert(consumption_data_map, sensor_index, service_locations, gateway_sensor_info)
@@ -71,36 +100,40 @@ def uaeSmappeeIngest(myTimer: func.TimerRequest) -> None:
         #clear_token_store(TOKEN_STORE_PATH)
 
         # Write to tsdb test_main table
-        _write_to_tsdb(db_conf, sensor_index, service_locations, gateway_sensor_info, consumption_data_map)
+        _write_to_tsdb(db_conf, sensor_index, service_locations, gateway_sensor_info, consumption_data_map, conn=conn)
 
     except Exception as e:
         logging.exception("Startup failure in SmartFlow timer handler: %s", e)
+    finally:
+        if conn is not None:
+            conn.close()
 
     logging.info('Completed UAE Smappee ingest')
 
 @log_timing()
 def test():
+    conn = None
     try:
         logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-        KV_URI = "https://uaeapicredentials.vault.azure.net/"
-        credential = DefaultAzureCredential()
-        kv = SecretClient(vault_url=KV_URI, credential=credential)
 
         # DB config
         db_conf = {
-            "password": kv.get_secret("tsdbPassword").value,
-            "port":     kv.get_secret("tsdbPort").value,
-            "host":     kv.get_secret("tsdbHost").value,
-            "name":     kv.get_secret("tsdbName").value,
-            "user":     kv.get_secret("tsdbUser").value,
+            "password": _get_secret("tsdbPassword"),
+            "port":     _get_secret("tsdbPort"),
+            "host":     _get_secret("tsdbHost"),
+            "name":     _get_secret("tsdbName"),
+            "user":     _get_secret("tsdbUser"),
         }
 
+        # One connection for every query in this run
+        conn = _connect_db(db_conf)
+
         sm_conf = {
             "grant_type": "password",
-            "client_id": kv.get_secret("uaeSmappeeClientID").value,
-            "client_secret": kv.get_secret("uaeSmappeeClientSecret").value,
-            "username": kv.get_secret("uaeSmappeeUsername").value,
-            "password": kv.get_secret("uaeSmappeePassword").value,
+            "client_id": _get_secret("uaeSmappeeClientID"),
+            "client_secret": _get_secret("uaeSmappeeClientSecret"),
+            "username": _get_secret("uaeSmappeeUsername"),
+            "password": _get_secret("uaeSmappeePassword"),
         }
         
 
@@ -114,19 +147,24 @@ def test():
         TOKEN_STORE_PATH = Path(tempfile.gettempdir()) / "uae_smartflow_tokens.json"
 
         #Get service locations, client ID and location ID from tsdb 
-        service_locations = _get_service_locations(db_conf) 
+        service_locations = _get_service_locations(db_conf, conn=conn) 
 
-        #Get index for sensors per sensor location
-        sensor_index = _get_index_for_sensors(service_locations, HEADERS)
+        # Consumption data only needs the service locations, so fetch it in the background
+        # while the sensor index and gateway lookups run
+        with ThreadPoolExecutor(max_workers=1) as ex:
+            #Get consumption data for and maps to each service location
+            consumption_future = ex.submit(_get_consumption_data, service_locations, HEADERS)
 
-        #Get unique sensor names from the index
-        sensor_set = _get_unique_sensor_names(sensor_index)
-        
-        #Get consumption data for and maps to each service location
-        consumption_data_map = _get_consumption_data(service_locations, HEADERS)
+            #Get index for sensors per sensor location
+            sensor_index = _get_index_for_sensors(service_locations, HEADERS)
+
+            #Get unique sensor names from the index
+            sensor_set = _get_unique_sensor_names(sensor_index)
+
+            ## Get gateway and sensor information for each service location from tsdb
+            gateway_sensor_info = _get_gateway_sensor_info(db_conf, service_locations, sensor_index, sensor_set, conn=conn)
 
-        ## Get gateway and sensor information for each service location from tsdb
-        gateway_sensor_info = _get_gateway_sensor_info(db_conf, service_locations, sensor_index, sensor_set)
+            consumption_data_map = consumption_future.result()
 
         # Assemble CSV to create insert statements for tsdb
         #_generate_insert(consumption_data_map, sensor_index, service_locations, gateway_sensor_info)
@@ -134,10 +172,13 @@ def test():
         #clear_token_store(TOKEN_STORE_PATH)
 
         # Write to tsdb test_main table
-        _write_to_tsdb(db_conf, sensor_index, service_locations, gateway_sensor_info, consumption_data_map)
+        _write_to_tsdb(db_conf, sensor_index, service_locations, gateway_sensor_info, consumption_data_map, conn=conn)
 
     except Exception as e:
         logging.exception("Startup failure in SmartFlow timer handler: %s", e)
+    finally:
+        if conn is not None:
+            conn.close()
 
 if __name__ == "__main__":
     test()
\ No newline at end of file
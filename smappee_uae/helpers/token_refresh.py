@@ -7,11 +7,13 @@ from pathlib import Path
 
 import requests
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
+# The Functions host already configures the root logger, only set one up for local runs
+if not logging.getLogger().hasHandlers():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
 
 # Writable in Azure Functions (Linux). Cleared when the instance recycles.
 TOKEN_STORE_PATH = Path(tempfile.gettempdir()) / "uae_smappee_token.json"
@@ -22,6 +24,9 @@ token_info = {
     "expires_at": 0.0,  # epoch seconds
 }
 
+# mtime of the token store when it was last read, so an unchanged file isn't re-parsed
+_loaded_mtime = None
+
 def clear_token_store(token_path) -> None:
     logging.info("Clearing tokens")
     try:
@@ -32,12 +37,18 @@ def clear_token_store(token_path) -> None:
         logging.warning("Could not clear token store: %s", e)
 
 def _load_token_from_tmp() -> None:
-    if not TOKEN_STORE_PATH.exists():
+    global _loaded_mtime
+    try:
+        mtime = TOKEN_STORE_PATH.stat().st_mtime
+    except OSError:
+        return
+    if mtime == _loaded_mtime:
         return
     try:
         data = json.loads(TOKEN_STORE_PATH.read_text())
         token_info["access_token"] = data.get("access_token")
         token_info["expires_at"] = float(data.get("expires_at") or 0)
+        _loaded_mtime = mtime
         logging.info("Loaded Smappee token from %s", TOKEN_STORE_PATH)
         logging.info(token_info)
     except Exception as e:
@@ -97,7 +108,9 @@ def _is_token_valid() -> bool:
 
 def _get_active_token(sm_conf: dict) -> str:
     """Per-instance, ephemeral cache in /tmp."""
-    _load_token_from_tmp()
+    # Warm workers usually hold a valid token in memory; only fall back to the store when they don't
+    if not _is_token_valid():
+        _load_token_from_tmp()
     if not _is_token_valid():
         _get_token(sm_conf)
     return token_info["access_token"]
@@ -1,16 +1,81 @@
 # 11/09/25 11:25 Writing to main
 import logging
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 
 import azure.functions as func
 from azure.keyvault.secrets import SecretClient
 from azure.identity import DefaultAzureCredential
 
-from helpers.helpers import _create_rows, _get_data_smartflow, _get_devices, _write_to_tsdb, clear_token_store, get_active_token
+from helpers.helpers import _connect_db, _get_data_smartflow, _get_devices, _write_to_tsdb, get_active_token
 
 app = func.FunctionApp()
 
+KV_URI = "https://wffunctionappsvault.vault.azure.net/"
+
+# Credential and Key Vault client live for the lifetime of the worker so the credential's token cache
+# carries across invocations. Built on first use, no network at import time
+@lru_cache(maxsize=None)
+def _get_kv_client() -> SecretClient:
+    return SecretClient(vault_url=KV_URI, credential=DefaultAzureCredential())
+
+# Secrets rarely change, so they are cached per worker and re-read after SECRET_TTL_SECS
+# so a rotated password is still picked up without a restart
+SECRET_TTL_SECS = 6 * 60 * 60
+_secret_cache = {}
+
+# Cached value if it is still within SECRET_TTL_SECS, otherwise None
+def _cached_secret(name: str):
+    cached = _secret_cache.get(name)
+    if cached and time.monotonic() - cached[1] < SECRET_TTL_SECS:
+        return cached[0]
+    return None
+
+def _get_secret(name: str) -> str:
+    value = _cached_secret(name)
+    if value is not None:
+        return value
+    value = _get_kv_client().get_secret(name).value
+    _secret_cache[name] = (value, time.monotonic())
+    return value
+
+# Returns cached secrets directly and fetches only the missing ones concurrently,
+# each Key Vault call is an independent round-trip. Warm runs never start a pool
+def _get_secrets(*names: str) -> dict:
+    secrets = {}
+    missing = []
+    for name in names:
+        value = _cached_secret(name)
+        if value is None:
+            missing.append(name)
+        else:
+            secrets[name] = value
+    if missing:
+        # Build the Key Vault client here first: lru_cache doesn't serialise a cold first call,
+        # so pool threads racing on it would each create their own credential and token
+        _get_kv_client()
+        with ThreadPoolExecutor(max_workers=len(missing)) as ex:
+            secrets.update(zip(missing, ex.map(_get_secret, missing)))
+    return secrets
+
+# SmartFlow endpoints
+TOKEN_URL = "https://api.smartflowmonitoring.com/v3.1/users/login/token/"
+REFRESH_URL = "https://api.smartflowmonitoring.com/v3.1/users/refresh/?token="
+
+# Store in /tmp (Linux) or sandbox temp (Windows)
+TOKEN_STORE_PATH = Path(tempfile.gettempdir()) / "smartflow_tokens.json"
+
+# In-memory copy, kept for the life of the worker so warm runs reuse a valid token
+token_info = {
+    "access_token": "",
+    "refresh_token": "",
+    "access_expires": 0,
+    "refresh_expires": 0,
+}
+
 @app.timer_trigger(
     schedule="0 0/30 * * * *", 
     arg_name="sfTimer",
@@ -24,24 +89,26 @@ def smartflowIngest(sfTimer: func.TimerRequest) -> None:
     datefmt="%Y-%m-%d %H:%M:%S",
     )
     logging.info("SmartFlow timer fired.")
+    conn = None
     try:
-        KV_URI = "https://wffunctionappsvault.vault.azure.net/"
-        credential = DefaultAzureCredential()
-        kv = SecretClient(vault_url=KV_URI, credential=credential)
+        secrets = _get_secrets(
+            "tsdbPassword", "tsdbPort", "tsdbHost", "tsdbName", "tsdbUser",
+            "smartflowUsername", "smartflowPassword",
+        )
 
         # DB config
         db_conf = {
-            "password": kv.get_secret("tsdbPassword").value,
-            "port":     kv.get_secret("tsdbPort").value,
-            "host":     kv.get_secret("tsdbHost").value,
-            "name":     kv.get_secret("tsdbName").value,
-            "user":     kv.get_secret("tsdbUser").value,
+            "password": secrets["tsdbPassword"],
+            "port":     secrets["tsdbPort"],
+            "host":     secrets["tsdbHost"],
+            "name":     secrets["tsdbName"],
+            "user":     secrets["tsdbUser"],
         }
 
         # SmartFlow creds
         sf_user = {
-            "sf_username": kv.get_secret("smartflowUsername").value,
-            "password":    kv.get_secret("smartflowPassword").value,
+            "sf_username": secrets["smartflowUsername"],
+            "password":    secrets["smartflowPassword"],
         }
 
         # Endpoints
@@ -49,21 +116,6 @@ def smartflowIngest(sfTimer: func.TimerRequest) -> None:
             "usage":   "https://api.smartflowmonitoring.com/v3.1/water_usage",
             "devices": "https://api.smartflowmonitoring.com/v3.1/devices",
         }
-        # SmartFlow endpoints
-        TOKEN_URL = "https://api.smartflowmonitoring.com/v3.1/users/login/token/"
-        REFRESH_URL = "https://api.smartflowmonitoring.com/v3.1/users/refresh/?token="
-
-        # Store in /tmp (Linux) or sandbox temp (Windows)
-        TOKEN_STORE_PATH = Path(tempfile.gettempdir()) / "smartflow_tokens.json"
-
-        # In-memory copy
-        token_info = {
-            "access_token": "",
-            "refresh_token": "",
-            "access_expires": 0,  
-            "refresh_expires": 0, 
-        }
-
         # Token
         access_token, _ = get_active_token(TOKEN_STORE_PATH, token_info, TOKEN_URL, REFRESH_URL, sf_user )
         headers = {
@@ -73,13 +125,17 @@ def smartflowIngest(sfTimer: func.TimerRequest) -> None:
 
         # Pull > transform > load
         devices = _get_devices(sf_urls["devices"], headers)
-        results = _get_data_smartflow(devices, headers, sf_urls["usage"])
-        rows = _create_rows(results)
-        _write_to_tsdb(rows, db_conf)
-        clear_token_store(TOKEN_STORE_PATH)
+        rows = _get_data_smartflow(devices, headers, sf_urls["usage"])
+        # Opened after the token refresh and API calls so it doesn't sit idle through them. Closed in finally
+        conn = _connect_db(db_conf)
+        _write_to_tsdb(rows, db_conf, conn=conn)
+        #clear_token_store(TOKEN_STORE_PATH)
 
     except Exception as e:
         logging.exception("Startup failure in SmartFlow timer handler: %s", e)
+    finally:
+        if conn is not None:
+            conn.close()
 
 
     logging.info("SmartFlow timer run complete.")
\ No newline at end of file
@@ -1,12 +1,51 @@
-import json, logging, os, requests, time, pytz, pg8000
+import orjson, logging, os, requests, time, pytz, pg8000, threading, tempfile
+from pathlib import Path
 from typing import Tuple, Optional
 from datetime import datetime as dt, timedelta
+from urllib.parse import urlencode
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib3.util.retry import Retry
+
+# Shared across every SmartFlow call in the worker so requests to the API host reuse kept-alive connections.
+# Transient failures (including on the token endpoint) are retried with backoff; the last response is still
+# returned rather than raised so callers log the status as before
+session = requests.Session()
+session.mount("https://", requests.adapters.HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET", "POST"],
+        raise_on_status=False,
+    ),
+))
+
+# Upper bound on concurrent per-device usage requests
+MAX_WORKERS = 8
+
+# Device inventory changes on the order of days, so the filtered device map is kept in memory
+# and in /tmp (like the token store) for DEVICE_TTL_SECS, which also covers cold starts
+DEVICE_TTL_SECS = 3600
+DEVICE_CACHE_PATH = Path(tempfile.gettempdir()) / "smartflow_devices.json"
+_device_cache = None
+
+# Only devices whose name contains this are ingested. The devices endpoint has no name filter, so it is applied client-side
+DEVICE_NAME_FILTER = "Tullamore Court"
+
+# Fixed columns for every SmartFlow row
+CLIENT_ID = "CTvx846sF9Y"
+LOCATION_ID = "Lpj1hzfJimw"
+METRIC = "water"
+SENSOR = "1"
 
 def _load_token_from_tmp(token_path, token_info) -> None:
     if not token_path.exists():
         return
     try:
-        data = json.loads(token_path.read_text())
+        data = orjson.loads(token_path.read_bytes())
         for k in ("access_token", "refresh_token", "access_expires", "refresh_expires"):
             if k in data:
                 token_info[k] = data[k]
@@ -22,27 +61,25 @@ def _write_token_to_tmp(token_path, token_info) -> None:
         "access_expires": int(token_info["access_expires"]),
         "refresh_expires": int(token_info["refresh_expires"]),
     }
+    # os.replace renames tmp_path away on success, so it only needs removing when the write fails
     try:
-        tmp_path.write_text(json.dumps(payload))
-        os.replace(tmp_path, token_path) 
-        logging.info("Updated token store at %s", token_path)
-    finally:
-        if tmp_path.exists():
-            try:
-                tmp_path.unlink()
-            except Exception:
-                pass
+        tmp_path.write_bytes(orjson.dumps(payload))
+        os.replace(tmp_path, token_path)
+    except Exception:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    logging.info("Updated token store at %s", token_path)
 
 def fetch_token(grant_type: str, payload: dict, TOKEN_URL, REFRESH_URL, token_info) -> dict:
     url = TOKEN_URL if grant_type == "password" else REFRESH_URL + token_info["refresh_token"]
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    resp = requests.post(url, data=payload, headers=headers, timeout=10)
+    resp = session.post(url, data=payload, headers=headers, timeout=10)
     try:
         resp.raise_for_status()
     except requests.HTTPError:
         logging.error("Token request failed [%s]: %s", resp.status_code, resp.text)
         raise
-    return resp.json()
+    return orjson.loads(resp.content)
 
 def get_token(token_path, token_info, TOKEN_URL, REFRESH_URL, sf_user: dict, use_refresh: bool = False) -> None:
     if use_refresh:
@@ -72,24 +109,43 @@ def get_token(token_path, token_info, TOKEN_URL, REFRESH_URL, sf_user: dict, use
     _write_token_to_tmp(token_path, token_info)
     logging.info("✅ Tokens updated.")
 
+# Tokens are refreshed this long before they expire, so one fetched at the start of a run
+# never lapses part-way through the device requests
+TOKEN_REFRESH_MARGIN_SECS = 300
+_token_lock = threading.Lock()
+
+# The token store is only read on the first call in a worker; after that token_info in memory is
+# authoritative and the file is only rewritten by get_token after a refresh
+_token_loaded = False
+
 def get_active_token(token_path, token_info, TOKEN_URL, REFRESH_URL, sf_user: Optional[dict] = None) -> Tuple[str, str]:
-    _load_token_from_tmp(token_path, token_info)
-    now = int(time.time())
+    global _token_loaded
+    with _token_lock:
+        if not _token_loaded:
+            _load_token_from_tmp(token_path, token_info)
+            _token_loaded = True
+        refresh_at = int(time.time()) + TOKEN_REFRESH_MARGIN_SECS
 
-    if not token_info["access_token"]:
-        if sf_user is None:
-            raise RuntimeError("sf_user required for initial token acquisition.")
-        get_token(token_path, token_info, TOKEN_URL, REFRESH_URL, sf_user, use_refresh=False)
-    elif now >= token_info["refresh_expires"]:
-        if sf_user is None:
-            raise RuntimeError("sf_user required to re-acquire expired refresh token.")
-        get_token(token_path, token_info, TOKEN_URL, REFRESH_URL, sf_user, use_refresh=False)
-    elif now >= token_info["access_expires"]:
-        get_token(token_path, token_info, TOKEN_URL, REFRESH_URL, sf_user, use_refresh=True)
-    else:
-        logging.info("✅ Access token still valid.")
+        if not token_info["access_token"]:
+            if sf_user is None:
+                raise RuntimeError("sf_user required for initial token acquisition.")
+            get_token(token_path, token_info, TOKEN_URL, REFRESH_URL, sf_user, use_refresh=False)
+        elif refresh_at >= token_info["refresh_expires"]:
+            if sf_user is None:
+                raise RuntimeError("sf_user required to re-acquire expired refresh token.")
+            get_token(token_path, token_info, TOKEN_URL, REFRESH_URL, sf_user, use_refresh=False)
+        elif refresh_at >= token_info["access_expires"]:
+            try:
+                get_token(token_path, token_info, TOKEN_URL, REFRESH_URL, sf_user, use_refresh=True)
+            except requests.HTTPError:
+                if sf_user is None:
+                    raise
+                logging.warning("Refresh failed, falling back to a new access token")
+                get_token(token_path, token_info, TOKEN_URL, REFRESH_URL, sf_user, use_refresh=False)
+        else:
+            logging.info("✅ Access token still valid.")
 
-    return token_info["access_token"], token_info["refresh_token"]
+        return token_info["access_token"], token_info["refresh_token"]
 
 def clear_token_store(token_path) -> None:
     try:
@@ -102,36 +158,72 @@ def clear_token_store(token_path) -> None:
 # ---------------------------
 # DB helper
 # ---------------------------
-def _query_db(db_conf: dict, query, params=None, fetch=True, many=False):
-    logging.info("Running db query fetch=%s many=%s", fetch, many)
+def _connect_db(db_conf: dict):
+    return pg8000.connect(
+        host=db_conf["host"],
+        database=db_conf["name"],
+        user=db_conf["user"],
+        password=db_conf["password"],
+        port=int(db_conf["port"]),
+    )
+
+# Yields conn when the caller passes one (and leaves closing it to them), otherwise a one-off connection.
+# A failed statement is rolled back so a shared connection stays usable
+@contextmanager
+def _db_connection(db_conf: dict, conn=None):
+    connection = conn or _connect_db(db_conf)
     try:
-        with pg8000.connect(
-            host=db_conf["host"],
-            database=db_conf["name"],
-            user=db_conf["user"],
-            password=db_conf["password"],
-            port=int(db_conf["port"]),
-        ) as connection:
-            with connection.cursor() as cursor:
-                if many:
-                    cursor.executemany(query, params)
-                else:
-                    cursor.execute(query, params or [])
-                if fetch:
-                    return cursor.fetchall()
-            connection.commit()
-    except Exception as e:
-        logging.exception("Database operation failed: %s", e)
-        return [] if fetch else False
+        yield connection
+    except Exception:
+        try:
+            connection.rollback()
+        except Exception:
+            pass
+        raise
+    finally:
+        if conn is None:
+            connection.close()
 
 # ---------------------------
 # SmartFlow helpers
 # ---------------------------
+# {"fetched_at": epoch, "devices": [[device_id, device_name], ...]}; pairs keep device_id's JSON type
+def _load_device_cache() -> dict:
+    global _device_cache
+    if _device_cache is None:
+        try:
+            _device_cache = orjson.loads(DEVICE_CACHE_PATH.read_bytes())
+        except (OSError, ValueError):
+            _device_cache = {}
+    return _device_cache
+
+def _write_device_cache(cache: dict) -> None:
+    tmp_path = DEVICE_CACHE_PATH.with_suffix(".tmp")
+    try:
+        tmp_path.write_bytes(orjson.dumps(cache))
+        os.replace(tmp_path, DEVICE_CACHE_PATH)
+    except OSError as e:
+        logging.warning("Could not write device cache %s: %s", DEVICE_CACHE_PATH, e)
+
 def _get_devices(device_url: str, headers: dict) -> dict:
-    resp = requests.get(url=device_url, headers=headers, timeout=15)
+    global _device_cache
+    cache = _load_device_cache()
+    if cache and time.time() - cache["fetched_at"] < DEVICE_TTL_SECS:
+        did_name = dict(cache["devices"])
+        logging.info("Using %d cached %s devices", len(did_name), DEVICE_NAME_FILTER)
+        return did_name
+
+    did_name = _fetch_devices(device_url, headers)
+    if did_name:
+        _device_cache = {"fetched_at": time.time(), "devices": list(did_name.items())}
+        _write_device_cache(_device_cache)
+    return did_name
+
+def _fetch_devices(device_url: str, headers: dict) -> dict:
+    resp = session.get(url=device_url, headers=headers, timeout=15)
     logging.info("Devices response: %s", resp.status_code)
     resp.raise_for_status()
-    payload = resp.json()
+    payload = orjson.loads(resp.content)
 
     if isinstance(payload, list):
         devices = payload
@@ -146,94 +238,118 @@ def _get_devices(device_url: str, headers: dict) -> dict:
     did_name = {}
     for device in devices:
         device_id = device.get("device_id")
-        settings = (device.get("device_settings") or {})
-        device_name = settings.get("device_name", "")
-        if device_id is not None and device_name and "Tullamore Court" in device_name:
+        device_name = (device.get("device_settings") or {}).get("device_name") or ""
+        if device_id is not None and DEVICE_NAME_FILTER in device_name:
             did_name[device_id] = device_name
-        else:
-            logging.debug("Skipping device %s (%s)", device_id, device_name)
 
-    logging.info("Found %d Tullamore Court devices", len(did_name))
+    logging.info("Found %d %s devices out of %d", len(did_name), DEVICE_NAME_FILTER, len(devices))
     return did_name
 
-def _get_data_smartflow(devices: dict, headers: dict, usage_url: str) -> dict:
+def _get_data_smartflow(devices: dict, headers: dict, usage_url: str) -> list:
     now = dt.now(pytz.utc).replace(minute=0, second=0, microsecond=0)
     time_to = now.strftime("%Y-%m-%dT%H:%M:%S")
     time_from = (now - timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%S")
 
-    params = {
+    # Same window for every device, so the query string is encoded once and appended to each URL
+    query = urlencode({
         "agg_type": "Hour",
         "start_date": time_from,
         "end_date": time_to,
         "id_type": "device_id",
         "uom": "Liters",
-    }
-
-    results = {
-        "time": [], "gateway": [], "value": [],
-        "note": [], "client_id": [], "location_id": [],
-        "metric": [], "sensor": []
-    }
+    })
+    url_template = f"{usage_url}/{{}}/aggregated?{query}"
 
-    for device_id, device_name in devices.items():
-        url = f"{usage_url}/{device_id}/aggregated"
-        try:
-            resp = requests.get(url, headers=headers, params=params, timeout=20)
-            logging.info("Usage %s -> %s", url, resp.status_code)
-            if resp.status_code != 200:
-                logging.warning("Skipping %s: HTTP %s", device_id, resp.status_code)
-                continue
-
-            payload = resp.json()
-            _process_data(payload, device_id, device_name, results, time_to)
-        except Exception as e:
-            logging.exception("Usage fetch failed for %s: %s", device_id, e)
-
-    return results
-
-def _process_data(payload, device_id, device_name, results, time_to):
-    usage = payload.get("usage_data", []) or []
-    value = float((usage[0].get("Usage") if usage else 0) or 0)
-
-    results["time"].append(time_to)
-    results["gateway"].append(device_id)
-    results["value"].append(value)
-    results["note"].append(device_name)
-    results["client_id"].append("CTvx846sF9Y")
-    results["location_id"].append("Lpj1hzfJimw")
-    results["metric"].append("water")
-    results["sensor"].append("1")
+    # Rows in main's column order: (time, client_id, location_id, metric, value, gateway, sensor, note)
+    rows = []
 
-    logging.info("Device %s (%s): %s litres", device_id, device_name, value)
+    # Requests run concurrently; each payload is processed here as it completes so rows is only touched by this thread
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        futures = {
+            ex.submit(_fetch_usage, url_template.format(device_id), headers): device_id
+            for device_id in devices
+        }
+        for fut in as_completed(futures):
+            device_id = futures[fut]
+            try:
+                payload = fut.result()
+                if payload is None:
+                    continue
+                _process_data(payload, device_id, devices[device_id], rows, time_to)
+            except Exception as e:
+                logging.exception("Usage fetch failed for %s: %s", device_id, e)
 
-def _create_rows(results) -> list:
-    rows = list(zip(
-        results["time"],
-        results["client_id"],
-        results["location_id"],
-        results["metric"],
-        results["value"],
-        results["gateway"],
-        results["sensor"],
-        results["note"],
-    ))
     logging.info("Prepared %d rows", len(rows))
     return rows
 
-def _write_to_tsdb(rows: list, db_conf: dict):
+def _fetch_usage(url: str, headers: dict):
+    resp = session.get(url, headers=headers, timeout=20)
+    logging.info("Usage %s -> %s", url, resp.status_code)
+    if resp.status_code != 200:
+        logging.warning("Skipping %s: HTTP %s", url, resp.status_code)
+        return None
+    return orjson.loads(resp.content)
+
+def _process_data(payload, device_id, device_name, rows, time_to):
+    usage = payload.get("usage_data") or []
+    value = (usage[0].get("Usage") if usage else 0) or 0
+    # orjson already yields int/float for JSON numbers; only coerce strings
+    if not isinstance(value, (int, float)):
+        value = float(value)
+
+    rows.append((time_to, CLIENT_ID, LOCATION_ID, METRIC, value, device_id, SENSOR, device_name))
+
+    logging.info("Device %s (%s): %s litres", device_id, device_name, value)
+
+# Rows per COPY data message sent to Postgres
+COPY_CHUNK_ROWS = 1000
+
+# COPY text format: None is \N, and backslash, tab, newline and carriage return are backslash-escaped
+# so API-supplied values (device names, ids) can't shift columns or end a row early
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+def _copy_field(v) -> str:
+    return "\\N" if v is None else str(v).translate(_COPY_ESCAPES)
+
+# Formats rows as COPY text lines and yields them in chunks of COPY_CHUNK_ROWS
+def _iter_copy_chunks(rows, chunk_rows=COPY_CHUNK_ROWS):
+    lines = []
+    for r in rows:
+        lines.append("\t".join(map(_copy_field, r)) + "\n")
+        if len(lines) >= chunk_rows:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+
+# COPY rows into a temp table, then INSERT ... SELECT ... ON CONFLICT DO NOTHING into main,
+# all in one transaction
+def _write_to_tsdb(rows: list, db_conf: dict, conn=None):
     if not rows:
         logging.info("No rows to insert.")
         return
-    insert_sql = """
-        INSERT INTO main
-        (time, client_id, location_id, metric, value, gateway, sensor, note)
-        VALUES
-        (%s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (time, client_id, location_id, metric, gateway, sensor)
-        DO NOTHING;
-    """
-    ok = _query_db(db_conf, insert_sql, rows, fetch=False, many=True)
-    if ok is False:
-        logging.error("Insert failed.")
-    else:
-        logging.info("Inserted %d rows", len(rows))
\ No newline at end of file
+
+    try:
+        with _db_connection(db_conf, conn) as connection:
+            cursor = connection.cursor()
+            cursor.execute("""
+                CREATE TEMP TABLE _ingest_smartflow
+                (LIKE main INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+                ON COMMIT DROP;
+            """)
+            cursor.execute(
+                "COPY _ingest_smartflow (time, client_id, location_id, metric, value, gateway, sensor, note) "
+                "FROM stdin WITH (FORMAT text)",
+                stream=_iter_copy_chunks(rows)
+            )
+            logging.info("Copied %d rows", cursor.rowcount)
+            cursor.execute("""
+                INSERT INTO main (time, client_id, location_id, metric, value, gateway, sensor, note)
+                SELECT time, client_id, location_id, metric, value, gateway, sensor, note
+                FROM _ingest_smartflow
+                ON CONFLICT (time, client_id, location_id, metric, gateway, sensor) DO NOTHING;
+            """)
+            connection.commit()
+            logging.info("Inserted %d rows", cursor.rowcount)
+    except Exception as e:
+        logging.exception("Insert failed: %s", e)